@@ -30,6 +30,7 @@ from .stacktools import *
 from .plot import *
 from .io import *
 from .config import config
+from . import profiling
 
 DEPTH_AXIS = 0
 VERTICAL_AXIS = 1
@@ -0,0 +1 @@
+from .benchmark import run, compare, measure, synthetic_stack, save, load, BENCHMARKS, SIZES
@@ -0,0 +1,62 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+import argparse
+import sys
+from .benchmark import run, compare, save, load, BENCHMARKS, SIZES, DTYPES
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m multipagetiff.benchmark',
+                                     description='Benchmark multipagetiff on synthetic stacks.')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, default=BENCHMARKS, help='benchmarks to run')
+    parser.add_argument('--sizes', nargs='+', choices=list(SIZES), default=['small'], help='stack sizes')
+    parser.add_argument('--dtypes', nargs='+', default=list(DTYPES), help='data types')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs of each case')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare the results with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown considered a regression')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25,
+                        help='relative peak memory increase considered a regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.only, args.sizes, args.dtypes, args.repeat, verbose=True)
+    if args.output:
+        save(results, args.output)
+
+    if args.baseline:
+        regressions = compare(results, load(args.baseline), args.tolerance, args.memory_tolerance)
+        for r in regressions:
+            print("REGRESSION {name} [{case}] {metric}: {value:.4g} vs {baseline:.4g} (x{ratio:.2f})".format(**r))
+        if regressions:
+            return 1
+        print("no regressions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+import json as _json
+import os as _os
+import platform as _platform
+import shutil as _shutil
+import statistics as _statistics
+import sys as _sys
+import tempfile as _tempfile
+import time as _time
+import tracemalloc as _tracemalloc
+import numpy as _np
+
+from .. import io as _io
+from .. import plot as _plot
+from .. import stacktools as _stacktools
+from ..stack import Stack as _Stack
+
+# (pages, rows, columns) of the synthetic stacks
+SIZES = {
+    'small': (16, 128, 128),
+    'medium': (64, 512, 512),
+    'large': (256, 1024, 1024),
+}
+DTYPES = ('uint8', 'uint16', 'float32')
+COMPRESSIONS = (None, 'deflate')
+BENCHMARKS = ('read_stack', 'write_stack', 'flatten', 'color_code', 'affine_transform',
+              'unpad_stack', 'load_and_apply_batch')
+
+
+def synthetic_stack(shape, dtype='uint16', seed=0, padding=0.1):
+    """A reproducible stack of smooth random blobs surrounded by a zero padding.
+
+    :param padding: fraction of each page border which is zero
+    """
+    rng = _np.random.default_rng(seed)
+    n, h, w = shape
+    # smooth pattern: a coarse random grid upsampled by repetition, plus noise
+    coarse = rng.random((n, max(h // 16, 1), max(w // 16, 1)))
+    data = _np.repeat(_np.repeat(coarse, 16, axis=1), 16, axis=2)[:, :h, :w]
+    data = _np.pad(data, ((0, 0), (0, h - data.shape[1]), (0, w - data.shape[2])), mode='edge')
+    data = 0.8 * data + 0.2 * rng.random(shape)
+    ph, pw = int(h * padding), int(w * padding)
+    data[:, :ph] = 0
+    data[:, h - ph:] = 0
+    data[:, :, :pw] = 0
+    data[:, :, w - pw:] = 0
+    dtype = _np.dtype(dtype)
+    if dtype.kind in 'ui':
+        data *= _np.iinfo(dtype).max
+    return data.astype(dtype)
+
+
+def measure(fn, repeat=3, setup=None):
+    """Time fn (the minimum and median of repeat runs) and measure the peak memory
+    it allocates (in a separate run, with tracemalloc).
+
+    :param setup: function called before each run, not timed; its result is passed to fn
+    :return: dict(seconds, median, peak_bytes)
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup is not None else None
+        t0 = _time.perf_counter()
+        fn(arg) if setup is not None else fn()
+        times.append(_time.perf_counter() - t0)
+
+    arg = setup() if setup is not None else None
+    _tracemalloc.start()
+    try:
+        fn(arg) if setup is not None else fn()
+        peak = _tracemalloc.get_traced_memory()[1]
+    finally:
+        _tracemalloc.stop()
+    return dict(seconds=min(times), median=_statistics.median(times), peak_bytes=int(peak))
+
+
+def _batch_item(pages):
+    return pages.max()
+
+
+def _cases(name, ctx):
+    """The (case label, function, setup) of the benchmark name for a synthetic stack"""
+    data = ctx['data']
+    stack = _Stack(data)
+    if name == 'read_stack':
+        for compression, path in ctx['files'].items():
+            yield str(compression), (lambda p=path: _io.read_stack(p, mmap=False)), None
+    elif name == 'write_stack':
+        for compression in COMPRESSIONS:
+            path = _os.path.join(ctx['dir'], 'write.tif')
+            yield str(compression), (lambda c=compression: _io.write_stack(stack, path, compression=c)), None
+    elif name == 'flatten':
+        yield '', (lambda: _plot.flatten(stack)), None
+    elif name == 'color_code':
+        yield '', (lambda: _plot.color_code(stack)), None
+    elif name == 'affine_transform':
+        shear = _np.array([[1, 0, 0], [0.5, 1, 0], [0, 0, 1.]])
+        yield 'order1', (lambda: _stacktools.affine_transform(stack, shear, order=1)), None
+    elif name == 'unpad_stack':
+        yield '', _stacktools.unpad_stack, stack.copy
+    elif name == 'load_and_apply_batch':
+        paths = [ctx['files'][None]] * 4
+        yield '4files', (lambda: _io.load_and_apply_batch(paths, _batch_item, ncpu=2)), None
+
+
+def run(benchmarks=BENCHMARKS, sizes=('small',), dtypes=DTYPES, repeat=3, verbose=False):
+    """Run the benchmarks on synthetic stacks and return the results (a JSON-serializable dict).
+
+    Everything runs offline, in a temporary directory.
+
+    :param benchmarks: the names of the benchmarks to run (see BENCHMARKS)
+    :param sizes: the sizes of the synthetic stacks (see SIZES)
+    """
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f"Unknown benchmarks {sorted(unknown)}. Use {BENCHMARKS}.")
+
+    results = []
+    tmp = _tempfile.mkdtemp(prefix='multipagetiff-benchmark-')
+    try:
+        for size in sizes:
+            for dtype in dtypes:
+                data = synthetic_stack(SIZES[size], dtype)
+                files = {}
+                for compression in COMPRESSIONS:
+                    files[compression] = _os.path.join(tmp, f'{size}-{dtype}-{compression}.tif')
+                    _io.write_stack(_Stack(data), files[compression], compression=compression)
+                ctx = dict(data=data, files=files, dir=tmp)
+
+                for name in benchmarks:
+                    for label, fn, setup in _cases(name, ctx):
+                        case = ','.join(x for x in (size, dtype, label) if x)
+                        result = dict(name=name, case=case, **measure(fn, repeat, setup))
+                        results.append(result)
+                        if verbose:
+                            print("{name:22s} {case:28s} {seconds:9.4f} s {mb:9.1f} MB".format(
+                                mb=result['peak_bytes'] / 2**20, **result))
+    finally:
+        _shutil.rmtree(tmp, ignore_errors=True)
+
+    return dict(meta=metadata(repeat=repeat), results=results)
+
+
+def metadata(**kwargs):
+    """Description of the environment of a benchmark run"""
+    from .. import __name__ as package
+    try:
+        from importlib.metadata import version
+        package_version = version(package)
+    except Exception:
+        package_version = 'unknown'
+    return dict(package_version=package_version, python=_sys.version.split()[0], numpy=_np.__version__,
+                platform=_platform.platform(), cpus=_os.cpu_count(), time=_time.strftime('%Y-%m-%dT%H:%M:%S'),
+                **kwargs)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        _json.dump(results, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return _json.load(f)
+
+
+def compare(results, baseline, tolerance=0.25, memory_tolerance=0.25):
+    """Compare benchmark results with a baseline.
+
+    A case is a regression if it is slower than the baseline by more than tolerance
+    (relative), or if its peak memory is larger by more than memory_tolerance.
+
+    :return: a list of dict(name, case, metric, value, baseline, ratio) for the regressions
+    """
+    reference = {(r['name'], r['case']): r for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        base = reference.get((r['name'], r['case']))
+        if base is None:
+            continue
+        for metric, tol in (('seconds', tolerance), ('peak_bytes', memory_tolerance)):
+            if base[metric] <= 0:
+                continue
+            ratio = r[metric] / base[metric]
+            if ratio > 1 + tol:
+                regressions.append(dict(name=r['name'], case=r['case'], metric=metric,
+                                        value=r[metric], baseline=base[metric], ratio=ratio))
+    return regressions
@@ -29,3 +29,9 @@ along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
 class config:
     cmap = None
     n_max_img_plot = 36      # max number of images to plot with plot_pages
+    page_cache_size = 512 * 2**20    # max bytes of decoded pages kept in memory by lazy stacks
+    page_cache_policy = 'lru'        # page cache eviction policy: 'lru' or 'fifo'
+    derived_pages_cache_entries = 8  # max number of normalized/cast selections kept by each stack
+    derived_pages_cache_size = 2 * 2**30  # max bytes of normalized/cast selections kept by each stack
+    profiling = False  # record timings, data sizes and cache hits (see multipagetiff.profiling)
+    profiling_sink = None  # callable (or list of callables) receiving the profiling events; None: profiling.counters
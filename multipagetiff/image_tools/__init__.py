@@ -1 +1,2 @@
 from .image_tools import unpad, normalize, EmptyImageException, estimate_zero_padding
+from .image_tools import percentiles, output_levels
@@ -26,33 +26,33 @@ along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import numpy as _np
+from ..profiling import span as _span
 
 
 class EmptyImageException(ValueError):
     pass
 
 
+def _bounds(mask):
+    """First and last index of the True values of a 1D mask"""
+    idx = _np.flatnonzero(mask)
+    return int(idx[0]), int(idx[-1])
+
+
 def estimate_zero_padding(img):
     """Estimate horizontal and vertical padding in an image.
 
-    Return value: a dictionary of two touples.
+    Return value: a dictionary of two touples,
+    the first and last (included) non-zero columns ('h') and rows ('v').
 
     """
-
-    if (img == 0).all():
+    rows = img.any(axis=1)
+    if not rows.any():
         raise EmptyImageException("The image is empty!")
 
     res = dict()
-
-    # horizontal
-    th_img = img.sum(axis=0) != 0
-    nonzero_indx = _np.argwhere(th_img).squeeze()
-    res['h'] = (int(nonzero_indx[0]), int(nonzero_indx[-1]))
-
-    # vertical
-    th_img = img.sum(axis=1) != 0
-    nonzero_indx = _np.argwhere(th_img).squeeze()
-    res['v'] = (int(nonzero_indx[0]), int(nonzero_indx[-1]))
+    res['h'] = _bounds(img.any(axis=0))
+    res['v'] = _bounds(rows)
 
     return res
 
@@ -68,25 +68,130 @@ def unpad(img):
     pad = estimate_zero_padding(img)
     hstart, hend = pad['h']
     vstart, vend = pad['v']
-    return img[vstart:vend, hstart:hend]
+    return img[vstart:vend+1, hstart:hend+1]
+
+
+def output_levels(dtype):
+    """Return the (MIN, MAX) levels of the normalization to the data type dtype.
+
+    MIN and MAX are the limits of the data type for integer types, 0 and 1 for float types.
+    """
+    dtype = _np.dtype(dtype)
+    if dtype.kind in 'ui':
+        return int(_np.iinfo(dtype).min), int(_np.iinfo(dtype).max)
+    if dtype.kind == 'b':
+        return 0, 1
+    return 0., 1.
+
+
+def exact_histogram_range(dtype):
+    """Return (min, max) for the types small enough to have one histogram bin per value
+    (8 and 16 bits integers, booleans), None for the other types."""
+    dtype = _np.dtype(dtype)
+    if dtype.kind == 'b':
+        return 0, 1
+    if dtype.kind in 'ui' and dtype.itemsize <= 2:
+        return int(_np.iinfo(dtype).min), int(_np.iinfo(dtype).max)
+    return None
+
 
+def histogram_percentile(counts, bin_edges, q):
+    """Estimate the q-th percentile(s) from a histogram (counts, bin_edges).
+
+    The estimate is exact if each bin holds one value (bin_edges[k] is the value of bin k).
+    """
+    cdf = _np.cumsum(counts)
+    k = _np.searchsorted(cdf, _np.asarray(q, dtype=_np.float64) / 100 * (cdf[-1] - 1), side='right')
+    k = _np.clip(k, 0, len(counts) - 1)
+    return bin_edges[k]
 
-def normalize(ndarray, output_dtype='same'):
-    output_dtype = ndarray if output_dtype == 'same' else output_dtype
 
-    try:
-        min_level = _np.iinfo(output_dtype).min
-        max_level = _np.iinfo(output_dtype).max
-    except ValueError:
-        # the output type is not an integer type
-        min_level = 0
-        max_level = 1
+def _range(ndarray, chunk):
+    vmin, vmax = None, None
+    for i in range(0, len(ndarray), chunk):
+        block = _np.asarray(ndarray[i:i+chunk])
+        vmin = block.min() if vmin is None else min(vmin, block.min())
+        vmax = block.max() if vmax is None else max(vmax, block.max())
+    return vmin, vmax
 
-    imgs = ndarray.astype(_np.float64)
 
-    imgs -= ndarray.min()
-    imgs /= ndarray.max() - ndarray()
-    imgs *= max_level + min_level
-    imgs -= min_level
+def percentiles(ndarray, q, chunk=16, bins=4096):
+    """Return the q-th percentile(s) of the values of ndarray, computed from a histogram
+    that is filled chunk by chunk (chunk items along the first axis at a time).
 
-    return imgs.astype(output_dtype)
+    For 8 and 16 bits integer data the histogram has one bin per value and the result is exact,
+    otherwise it has bins bins between the min and max of the data.
+    """
+    exact = exact_histogram_range(ndarray.dtype)
+    if exact is not None:
+        edges = _np.arange(exact[0], exact[1] + 2)
+    else:
+        edges = _np.histogram_bin_edges([], bins=bins, range=tuple(float(v) for v in _range(ndarray, chunk)))
+    counts = _np.zeros(len(edges) - 1, dtype=_np.int64)
+    for i in range(0, len(ndarray), chunk):
+        block = _np.asarray(ndarray[i:i+chunk])
+        if exact is not None:
+            counts += _np.bincount(block.ravel().astype(_np.int64) - exact[0], minlength=len(counts))
+        else:
+            counts += _np.histogram(block, bins=edges)[0]
+    return histogram_percentile(counts, edges, q)
+
+
+def normalize(ndarray, output_dtype='same', out=None, vmin=None, vmax=None, clip=None, chunk=16):
+    """Rescale the values of ndarray between MIN and MAX.
+
+    The values of MIN and MAX depend on the output data type:
+    if the data type is float: MIN=0, MAX=1;
+    if the data type is integer: MIN and MAX are the limits of the data type.
+
+    The array is processed chunk by chunk (chunk items along the first axis at a time),
+    in float32 arithmetic (float64 for 32 and 64 bits data or a float64 output),
+    and written directly in the output array. ndarray can be any sliceable array-like
+    (e.g. a lazy stack of pages).
+
+    :param output_dtype: the data type of the result, 'same' for the type of ndarray
+    :param out: a preallocated output array (of the shape of ndarray)
+    :param vmin, vmax: the input values mapped to MIN and MAX (default: the min and max of ndarray)
+    :param clip: (low, high) percentiles of the input values mapped to MIN and MAX,
+        the values outside are saturated. Overrides vmin and vmax.
+    :return: the normalized array
+    """
+    with _span('normalize', clip=clip) as event:
+        output_dtype = ndarray.dtype if str(output_dtype) == 'same' else _np.dtype(output_dtype)
+        out_allocated = out is None
+        if out is None:
+            out = _np.empty(ndarray.shape, dtype=output_dtype)
+        elif out.shape != tuple(ndarray.shape):
+            raise ValueError(f"out has shape {out.shape}, expected {tuple(ndarray.shape)}")
+        output_dtype = out.dtype
+        min_level, max_level = output_levels(output_dtype)
+
+        if clip is not None:
+            vmin, vmax = percentiles(ndarray, clip, chunk=chunk)
+        elif vmin is None or vmax is None:
+            data_min, data_max = _range(ndarray, chunk)
+            vmin = data_min if vmin is None else vmin
+            vmax = data_max if vmax is None else vmax
+
+        input_dtype = _np.dtype(ndarray.dtype)
+        if (input_dtype.itemsize > 2 and input_dtype != _np.float32) or output_dtype == _np.float64:
+            work_dtype = _np.float64
+        else:
+            work_dtype = _np.float32
+
+        vmin = float(vmin)
+        scale = (max_level - min_level) / (float(vmax) - vmin) if vmax != vmin else 0.
+        integer_output = output_dtype.kind in 'uib'
+
+        for i in range(0, len(ndarray), chunk):
+            block = _np.asarray(ndarray[i:i+chunk]).astype(work_dtype)
+            block -= vmin
+            block *= scale
+            block += min_level
+            _np.clip(block, min_level, max_level, out=block)
+            if integer_output:
+                _np.rint(block, out=block)
+            out[i:i+chunk] = block
+        event.data(out, allocated=out_allocated)
+
+    return out
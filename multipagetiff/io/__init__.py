@@ -1 +1,3 @@
-from .io import read_stack, write_stack, load_and_apply, load_and_apply_batch
+from .io import read_stack, write_stack, load_and_apply, load_and_apply_batch, load_and_reduce, iter_pages
+from .shared import share_stack, SharedStack
+from .batch import run_batch, BatchReport, BatchError
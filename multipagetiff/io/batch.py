@@ -0,0 +1,245 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+import multiprocessing as _mp
+from multiprocessing.pool import ThreadPool as _ThreadPool
+import os as _os
+import pickle as _pickle
+import threading as _threading
+import time as _time
+import traceback as _traceback
+from tqdm import tqdm as _tqdm
+
+
+class BatchError(RuntimeError):
+    pass
+
+
+def default_workers():
+    """The default number of workers: all the CPUs but 3, at least one."""
+    return max(1, (_os.cpu_count() or 1) - 3)
+
+
+class ItemResult:
+    """The outcome of the processing of one item of a batch"""
+
+    __slots__ = ('index', 'item', 'ok', 'result', 'error', 'duration')
+
+    def __init__(self, index, item, ok, result=None, error=None, duration=0.):
+        self.index = index
+        self.item = item
+        self.ok = ok
+        self.result = result
+        self.error = error
+        self.duration = duration
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+
+    def __repr__(self):
+        status = 'ok' if self.ok else 'failed'
+        return "ItemResult({}, {!r}, {}, {:.3f}s)".format(self.index, self.item, status, self.duration)
+
+
+class BatchReport:
+    """The outcome of a batch.
+
+    - report.results: the results in the order of the items (None for failed items)
+    - report.failed: the ItemResult of the failed items, with their traceback in .error
+    - report.durations: the processing time of each item, in seconds
+    - report.items: all the ItemResult, in the order of the items
+    """
+
+    def __init__(self, items, resumed=0, wall_time=0.):
+        self.items = sorted(items, key=lambda r: r.index)
+        self.resumed = resumed
+        self.wall_time = wall_time
+
+    @property
+    def results(self):
+        return [r.result if r.ok else None for r in self.items]
+
+    @property
+    def failed(self):
+        return [r for r in self.items if not r.ok]
+
+    @property
+    def durations(self):
+        return [r.duration for r in self.items]
+
+    @property
+    def ok(self):
+        return len(self.failed) == 0
+
+    def raise_errors(self):
+        """Raise a BatchError describing the first failed item, if any"""
+        failed = self.failed
+        if failed:
+            raise BatchError("{} of {} items failed. First failure ({!r}):\n{}".format(
+                len(failed), len(self.items), failed[0].item, failed[0].error))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return "BatchReport({} items, {} failed, {} resumed from journal, {:.1f}s)".format(
+            len(self.items), len(self.failed), self.resumed, self.wall_time)
+
+
+def _run_item(indexed_item, f):
+    """Apply f to an item, capturing its errors and timing"""
+    index, item = indexed_item
+    t0 = _time.perf_counter()
+    try:
+        result = f(item)
+    except Exception:
+        return ItemResult(index, item, False, error=_traceback.format_exc(),
+                          duration=_time.perf_counter() - t0)
+    return ItemResult(index, item, True, result, duration=_time.perf_counter() - t0)
+
+
+def _read_journal(path):
+    """Return the records of a journal, ignoring a truncated last record"""
+    records = {}
+    if path is None or not _os.path.exists(path):
+        return records
+    with open(path, 'rb') as fh:
+        while True:
+            try:
+                record = _pickle.load(fh)
+            except EOFError:
+                break
+            except (_pickle.UnpicklingError, ValueError, AttributeError):
+                # interrupted while writing the last record
+                break
+            records[(record.index, str(record.item))] = record
+    return records
+
+
+class _Feeder:
+    """Yield the items to process, blocking while max_pending items are being processed."""
+
+    def __init__(self, items, max_pending):
+        self.items = items
+        self._slots = _threading.Semaphore(max_pending)
+        self._stop = _threading.Event()
+
+    def __iter__(self):
+        for item in self.items:
+            while not self._slots.acquire(timeout=0.1):
+                if self._stop.is_set():
+                    return
+            if self._stop.is_set():
+                return
+            yield item
+
+    def done(self):
+        self._slots.release()
+
+    def stop(self):
+        self._stop.set()
+
+
+def run_batch(items, f, executor='process', workers=None, chunksize=1, max_pending=None,
+              journal=None, retry_failed=True, progress_bar=False):
+    """Apply f to each item (e.g. the paths of tif files) in parallel.
+
+    The errors of each item are captured: a failing item does not stop the batch.
+    The items are distributed in chunks of chunksize items (imap_unordered)
+    and at most max_pending items are submitted at any time,
+    so that the results do not pile up in memory.
+
+    If journal is the path of a file, each result is appended to it as soon as it is available.
+    If the batch is interrupted, calling run_batch again with the same journal
+    only processes the items that were not completed (failed items are processed again
+    if retry_failed is True).
+
+    :param items: the list of the items to process
+    :param f: function of one item. With the 'process' executor, f must be picklable.
+    :param executor: 'process' (a multiprocessing.Pool) or 'thread' (a thread pool)
+    :param workers: number of processes or threads. Default: all the CPUs but 3, at least one.
+    :param chunksize: number of items sent to a worker at once
+    :param max_pending: maximal number of items being processed. Default: 4 * workers * chunksize
+    :param journal: path of the journal file, or None
+    :param retry_failed: if resuming from a journal, process again the items that failed
+    :param progress_bar: show a tqdm progress bar
+    :return: a BatchReport
+    """
+    if executor not in ('process', 'thread'):
+        raise ValueError("executor must be 'process' or 'thread'")
+    workers = default_workers() if workers is None else max(1, int(workers))
+    chunksize = max(1, int(chunksize))
+    max_pending = 4 * workers * chunksize if max_pending is None else max(int(max_pending), chunksize)
+
+    t0 = _time.perf_counter()
+    items = list(items)
+    done = {}
+    for key, record in _read_journal(journal).items():
+        if record.index < len(items) and str(items[record.index]) == key[1] \
+                and (record.ok or not retry_failed):
+            done[record.index] = record
+    resumed = len(done)
+    todo = [(i, item) for i, item in enumerate(items) if i not in done]
+
+    pool_class = _mp.Pool if executor == 'process' else _ThreadPool
+    feeder = _Feeder(todo, max_pending)
+    journal_fh = open(journal, 'ab') if journal is not None else None
+    desc = "Using {} {}".format(workers, 'processes' if executor == 'process' else 'threads')
+    bar = _tqdm(total=len(items), initial=resumed, desc=desc) if progress_bar else None
+
+    try:
+        with pool_class(workers) as pool:
+            for record in pool.imap_unordered(_Task(f), feeder, chunksize=chunksize):
+                feeder.done()
+                done[record.index] = record
+                if journal_fh is not None:
+                    _pickle.dump(record, journal_fh)
+                    journal_fh.flush()
+                if bar is not None:
+                    bar.update()
+    finally:
+        feeder.stop()
+        if journal_fh is not None:
+            journal_fh.close()
+        if bar is not None:
+            bar.close()
+
+    return BatchReport(done.values(), resumed=resumed, wall_time=_time.perf_counter() - t0)
+
+
+class _Task:
+    """A picklable callable running f on an indexed item"""
+
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, indexed_item):
+        return _run_item(indexed_item, self.f)
@@ -26,53 +26,370 @@ along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from .. import stack as _stack
+from ..stack.source import PageSource as _PageSource, SourceView as _SourceView
+from ..stack.cache import page_cache as _page_cache
+from ..profiling import span as _span, iterate as _iterate
+from ..parallel import ordered_map as _ordered_map
+from . import tiff as _tiff
+from . import shared as _shared
+from . import batch as _batch
+from .tiff import TiffIndex as _TiffIndex, TiffFormatError as _TiffFormatError, \
+    mapped_filename as _mapped_filename
 from PIL import Image as _Image
 import numpy as _np
-import multiprocessing as _mp
-from tqdm import tqdm as _tqdm
+import os as _os
+import struct as _struct
+import tempfile as _tempfile
+import threading as _threading
+import time as _time
+import concurrent.futures as _futures
 import functools as _ft
 
 
-def tiff2nparray(path):
-    """Transform a multipage tiff in numpy array
-    :param path: path of the tiff file
-    :return: a numpy array of shape (n,h,w) where n is the number of pages of the tiff file
+def _open_index(path):
+    """Return the TiffIndex of path, or None if path is not a tiff file that can be indexed."""
+    try:
+        return _TiffIndex(path)
+    except (_TiffFormatError, OSError, KeyError, IndexError, _struct.error):
+        return None
+
+
+def _selection(n_pages, shape, start=None, stop=None, step=None, crop=None):
+    """Normalize a page range and a crop rectangle.
+
+    :return: (range of page indices, row slice, column slice)
     """
+    pages = range(n_pages)[slice(start, stop, step)]
+    if crop is None:
+        crop = (None, None, None, None)
+    if len(crop) != 4:
+        raise ValueError("crop must be [vertical_start, vertical_end, horizontal_start, horizontal_end]")
+    rows = range(shape[0])[slice(crop[0], crop[1])]
+    cols = range(shape[1])[slice(crop[2], crop[3])]
+    if len(rows) == 0 or len(cols) == 0:
+        raise ValueError(f"The crop region {list(crop)} is empty for pages of shape {tuple(shape)}.")
+    return pages, slice(rows.start, rows.stop), slice(cols.start, cols.stop)
+
+
+def _read_raw_pages(index, pages, rows, cols, out):
+    """Read the selected rows of uncompressed (or deflate compressed) pages
+    of an indexed tiff file directly into out.
+
+    Only the bytes of the selected rows of uncompressed pages are read from the file.
+    """
+    first = index.page(pages[0]) if len(pages) else index.page(0)
+    row_bytes = first.nbytes // first.height
+    n_rows = rows.stop - rows.start
+    full_width = cols == slice(0, first.width)
+    buf = None if full_width else _np.empty((n_rows, *first.shape[1:]), dtype=first.dtype)
+
+    with open(index.path, 'rb') as fh:
+        for k, i in enumerate(pages):
+            page = index.page(i)
+            if page.compression != 1:
+                out[k] = page.inflate(fh)[rows, cols]
+                continue
+            fh.seek(page.data_offset + rows.start * row_bytes)
+            if full_width:
+                fh.readinto(out[k].reshape(-1).view(_np.uint8))
+            else:
+                fh.readinto(buf.reshape(-1).view(_np.uint8))
+                out[k] = buf[:, cols]
+
 
+def _decode_into(im, pages, rows=slice(None), cols=slice(None), out=None):
+    """Decode the selected pages of an open PIL image into out (or a new array)."""
+    for k, i in enumerate(pages):
+        im.seek(i)
+        frame = _np.asarray(im)[rows, cols]
+        if out is None:
+            out = _np.empty((len(pages), *frame.shape), dtype=frame.dtype)
+        out[k] = frame
+
+    if out is None:
+        raise ValueError("The page selection is empty.")
+    return out
+
+
+def _open_image(path):
     try:
-        im = _Image.open(path)
+        return _Image.open(path)
     except _Image.UnidentifiedImageError as e:
         # tiff file is probably not a 3D stack
         raise(e)
-    i = 0
-    frames = []
-    try:
-        while True:
-            im.seek(i)
-            frames.append(_np.array(im))
-            i += 1
-    except EOFError:
-        pass
 
-    return _np.array(frames)
 
+class _PageReader:
+    """Read blocks of pages of an image file.
+
+    The file is indexed (and opened) only once,
+    then each call to read() decodes only the requested pages.
+    """
+
+    def __init__(self, path, mmap=False, start=None, stop=None, step=None, crop=None):
+        self.path = path
+        self.index = _open_index(path)
+        self._im = None
+
+        if self.index is None:
+            # not a tiff file or an unsupported variant: let PIL handle it
+            self._im = _open_image(path)
+            n_pages = getattr(self._im, 'n_frames', 1)
+            shape = (self._im.height, self._im.width)
+            self.mode = 'decode'
+        else:
+            first = self.index.page(0)
+            n_pages, shape = len(self.index), first.shape
+
+        self.pages, self.rows, self.cols = _selection(n_pages, shape, start, stop, step, crop)
+        if len(self.pages) == 0:
+            raise ValueError("The page selection is empty.")
+
+        if self.index is None:
+            return
+        if mmap and self.index.is_memmappable:
+            self.mode = 'mmap'
+            self._mm = self.index.memmap()[start:stop:step, self.rows, self.cols]
+        elif all((self.index.page(i).is_contiguous or self.index.page(i).is_deflate)
+                 and self.index.page(i).same_layout(first) for i in self.pages):
+            self.mode = 'raw'
+            self.shape = (len(self.pages), self.rows.stop - self.rows.start,
+                          self.cols.stop - self.cols.start, *first.shape[2:])
+            self.dtype = first.dtype
+        else:
+            self.mode = 'decode'
+
+    def __len__(self):
+        return len(self.pages)
+
+    def read(self, k0=0, k1=None, workers=None):
+        """Return the selected pages k0 to k1 (excluded) as an array.
+
+        :param workers: number of threads decoding the pages in parallel (default 1).
+        """
+        k1 = len(self.pages) if k1 is None else k1
+        with _span('io.read_pages', mode=self.mode) as event:
+            return event.data(self._read(k0, k1, workers), allocated=self.mode != 'mmap')
+
+    def _read(self, k0, k1, workers):
+        if self.mode == 'mmap':
+            return self._mm[k0:k1]
+
+        pages = self.pages[k0:k1]
+        if self.mode == 'raw':
+            out = _np.empty((len(pages), *self.shape[1:]), dtype=self.dtype)
+            self._read_into(pages[:1], out[:1])
+        else:
+            if self._im is None:
+                self._im = _open_image(self.path)
+            first = _decode_into(self._im, pages[:1], self.rows, self.cols)
+            out = _np.empty((len(pages), *first.shape[1:]), dtype=first.dtype)
+            out[0] = first[0]
+
+        workers = 1 if workers is None else min(int(workers), len(pages) - 1)
+        if workers <= 1:
+            self._read_into(pages[1:], out[1:], self._im)
+            return out
+
+        # each thread decodes a contiguous block of pages with its own file handle,
+        # straight into the output array (PIL and file reads release the GIL)
+        bounds = _np.linspace(1, len(pages), workers + 1).astype(int)
+        blocks = [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+        with _futures.ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda b: self._read_into(pages[b], out[b]), blocks))
+        return out
+
+    def _read_into(self, pages, out, im=None):
+        """Read pages into out, using the open PIL image im if given."""
+        if len(pages) == 0:
+            return
+        if self.mode == 'raw':
+            _read_raw_pages(self.index, pages, self.rows, self.cols, out)
+        elif im is not None:
+            _decode_into(im, pages, self.rows, self.cols, out)
+        else:
+            with _open_image(self.path) as im:
+                _decode_into(im, pages, self.rows, self.cols, out)
+
+    def close(self):
+        if self._im is not None:
+            self._im.close()
+            self._im = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TiffPageSource(_PageSource):
+    """Pages of a tiff file decoded on demand.
+
+    Decoded pages are kept in a PageCache (by default the shared cache,
+    bounded by config.page_cache_size), so that the file can be larger than memory.
+    """
+
+    def __init__(self, reader, cache=None):
+        self._reader = reader
+        self._lock = _threading.Lock()
+        first = self._read_page(0)
+        super().__init__((len(reader), *first.shape), first.dtype,
+                         cache=_page_cache if cache is None else cache)
+        self.path = reader.path
+
+    def _read_page(self, i):
+        with self._lock:
+            return self._reader.read(i, i+1)[0]
+
+
+def tiff2nparray(path, mmap=False, start=None, stop=None, step=None, crop=None, workers=None):
+    """Transform a multipage tiff in numpy array
+
+    The chain of pages of the file is indexed once.
+    If the pages are stored uncompressed, they are read directly from the file,
+    otherwise they are decoded one by one into a preallocated array.
+    Only the selected pages are decoded and only the selected rows are copied.
+
+    :param path: path of the tiff file
+    :param mmap: if True and the pages are uncompressed, return a read-only memory map
+        of the file (a copy-on-write array) instead of loading the pages in memory.
+        Opening a file is then O(number of pages), not O(bytes).
+    :param start, stop, step: select the pages to read, as in pages[start:stop:step]
+    :param crop: [vertical_start, vertical_end, horizontal_start, horizontal_end]
+        the region of each page to read (start included, end excluded). None reads the whole page.
+    :param workers: number of threads decoding (compressed) pages in parallel. Default: 1
+    :return: a numpy array of shape (n,h,w) where n is the number of selected pages
+    """
+    with _PageReader(path, mmap=mmap, start=start, stop=stop, step=step, crop=crop) as reader:
+        return reader.read(workers=workers)
+
+
+def iter_pages(path, chunk=64, start=None, stop=None, step=None, crop=None, mmap=True, workers=None):
+    """Iterate over the pages of a tif file in blocks of (at most) chunk pages.
+
+    Only one block is in memory at a time,
+    so the memory needed is bounded by the size of a block, not the size of the file.
+    The selection parameters are the same as in tiff2nparray.
 
-def read_stack(path, dx=1, dz=1, title='', z_label='depth', units=''):
+    :param path: path of the tiff file
+    :param chunk: the number of pages of each block
+    :param workers: number of threads decoding the pages of a block in parallel
+    :return: a generator of numpy arrays of shape (chunk,h,w) (the last block can be shorter)
+    """
+    if chunk < 1:
+        raise ValueError("chunk must be a positive integer.")
+    with _PageReader(path, mmap=mmap, start=start, stop=stop, step=step, crop=crop) as reader:
+        blocks = (reader.read(k, min(k + chunk, len(reader)), workers=workers) for k in range(0, len(reader), chunk))
+        yield from _iterate('io.iter_pages', blocks)
+
+
+def read_stack(path, dx=1, dz=1, title='', z_label='depth', units='', mmap=True,
+               start=None, stop=None, step=None, crop=None, lazy=False, workers=None):
     """Load a stack form a tif file.
 
+    Only the selected pages and region are read (see tiff2nparray).
+
     :param path: (string) path to the tiff file
+    :param mmap: if True (default) uncompressed files are memory mapped instead of being loaded.
+    :param lazy: if True, the pages that can not be memory mapped are decoded on demand
+        and kept in a bounded cache (see config.page_cache_size), instead of being loaded.
+    :param workers: number of threads decoding (compressed) pages in parallel. Default: 1
+    :param start, stop, step: select the pages to read, as in pages[start:stop:step].
+        The dz of the returned stack is multiplied by step.
+    :param crop: [vertical_start, vertical_end, horizontal_start, horizontal_end] region to read.
     :return: a Stack object
     """
-    return _stack.Stack(tiff2nparray(path), dx=dx, dz=dz, title=title, z_label=z_label, units=units)
+    with _span('io.read_stack', lazy=lazy) as event:
+        reader = _PageReader(path, mmap=mmap, start=start, stop=stop, step=step, crop=crop)
+        event.details['mode'] = reader.mode
+        if lazy and reader.mode != 'mmap':
+            imgs = TiffPageSource(reader)
+        else:
+            with reader:
+                imgs = event.data(reader.read(workers=workers), allocated=reader.mode != 'mmap')
+    dz = dz * (1 if step is None else abs(step))
+    return _stack.Stack(imgs, dx=dx, dz=dz, title=title, z_label=z_label, units=units)
+
+
+def write_stack(stack, path="untitled.tif", compression=None, level=6, bigtiff=None, workers=None, chunk=16):
+    """Write the current pages of the stack as TIFF file
+
+    The pages are streamed to the file one at a time (read by blocks of chunk pages),
+    so the stack can be larger than memory (e.g. a memory-mapped or lazy stack).
+
+    :param compression: None or 'deflate' (zlib compression, lossless)
+    :param level: the compression level (1 fastest to 9 smallest)
+    :param bigtiff: write a BigTIFF file. If None (default) a BigTIFF is written
+        only if the data could exceed the 4GB limit of classic tiff files.
+    :param workers: number of threads compressing pages in parallel
+    :param chunk: number of pages read at once from the stack
+    """
+    if compression not in _tiff.COMPRESSIONS:
+        raise ValueError(f"Unknown compression {compression}. Use None or 'deflate'.")
+
+    nbytes = _selection_nbytes(stack)
+    if bigtiff is None:
+        bigtiff = nbytes > _tiff.CLASSIC_TIFF_LIMIT
+
+    with _span('io.write_stack', pages=len(stack), nbytes=nbytes, compression=compression):
+        _write_stack(stack, path, compression, level, bigtiff, workers, chunk)
+
+
+def _write_stack(stack, path, compression, level, bigtiff, workers, chunk):
+    if _os.path.exists(path) and _reads_from(stack, path):
+        # the stack data is read from the file being overwritten:
+        # write to a temporary file and replace the original at the end.
+        fd, tmp_path = _tempfile.mkstemp(suffix=_os.path.splitext(path)[1],
+                                         dir=_os.path.dirname(_os.path.abspath(path)))
+        _os.close(fd)
+        try:
+            _write_pages(stack, tmp_path, compression, level, bigtiff, workers, chunk)
+        except BaseException:
+            _os.remove(tmp_path)
+            raise
+        _os.replace(tmp_path, path)
+    else:
+        _write_pages(stack, path, compression, level, bigtiff, workers, chunk)
+
+
+def _write_pages(stack, path, compression, level, bigtiff, workers, chunk):
+    def prepared_pages():
+        for block in stack.iter_chunks(chunk):
+            for page in block:
+                yield _tiff.TiffWriter.prepare(page)
+
+    encode = _tiff.TiffWriter.encode
 
+    with _tiff.TiffWriter(path, bigtiff=bigtiff) as writer:
+        if _tiff.COMPRESSIONS[compression] == 1:
+            # nothing to compress
+            workers = 1
 
-def write_stack(stack, path="untitled.tif"):
-    """Write the current pages of the stack as TIFF file"""
-    imlist = []
-    for m in stack.pages:
-        imlist.append(_Image.fromarray(m))
+        # compress on a thread pool, write in order.
+        # At most 2*workers pages are waiting to be written.
+        def encoded(page):
+            return page, encode(page, compression, level)
 
-    imlist[0].save(path, save_all=True, append_images=imlist[1:])
+        for page, data in _ordered_map(encoded, prepared_pages(), workers):
+            writer.write_encoded(page, data, compression)
+
+
+def _selection_nbytes(stack):
+    """The size in bytes of the selected pages of a stack"""
+    start, end, r0, r1, c0, c1 = stack._crop
+    dtype = stack.raw_images.dtype if str(stack.dtype_out) == 'same' else _np.dtype(stack.dtype_out)
+    samples = int(_np.prod(stack.raw_images.shape[3:]))
+    return (end - start) * (r1 - r0) * (c1 - c0) * samples * dtype.itemsize
+
+
+def _reads_from(stack, path):
+    """True if the raw images of stack are read from the file path (memory mapped or lazy)"""
+    images = stack.raw_images
+    while isinstance(images, _SourceView):
+        images = images.parent
+    filename = getattr(images, 'path', None) or _mapped_filename(images)
+    return filename is not None and _os.path.samefile(filename, path)
 
 
 def load_and_apply(path, f, **kwargs):
@@ -86,25 +403,122 @@ def load_and_apply(path, f, **kwargs):
     return retval
 
 
-def load_and_apply_batch(paths, f=_np.sum, ncpu=None, progress_bar=False, **kwargs):
+def load_and_reduce(path, f, reduce=_np.add, chunk=64, **kwargs):
+    """Stream a tif stack through f in blocks of pages and reduce the results.
+
+    The stack is never loaded as a whole: f is applied to each block of
+    (at most) chunk pages and the partial results are combined with reduce.
+    e.g. the sum of a file: load_and_reduce(path, np.sum)
+         its max projection: load_and_reduce(path, np.max, reduce=np.maximum, axis=0)
+
+    :param f: function taking as input a block of pages (i.e. a 3D numpy array)
+    :param reduce: function combining two partial results (e.g. numpy.add, numpy.maximum)
+    :param chunk: number of pages per block
+    kwargs are passed to f
+    """
+    retval = None
+    for block in iter_pages(path, chunk=chunk):
+        r = f(block, **kwargs)
+        retval = r if retval is None else reduce(retval, r)
+    return retval
+
+
+def _apply_to_shared(item, apply, name, shape, dtype):
+    """Apply to the i-th path and write the result at position i of a shared array"""
+    i, path = item
+    result = apply(path)
+    _, out = _shared.attach_shared_array(name, shape, dtype)
+    out[i] = result
+
+
+def load_and_apply_batch(paths, f=_np.sum, ncpu=None, progress_bar=False, reduce=None, chunk=64,
+                         shared_output=False, out_shape=None, out_dtype=None,
+                         executor='process', chunksize=1, journal=None, errors='raise', **kwargs):
     """Load tif stacks and apply function f to each of them.
 
     f is a function that takes as input the pages of a stack (i.e. a 3D numpy array)
+    if reduce is given, the stacks are streamed by blocks of chunk pages (see load_and_reduce)
     kwargs are passed to f
+
+    The files are processed by run_batch (see its documentation for executor, chunksize and journal).
+    if errors is 'raise', a BatchError is raised if any file fails, after all the files are processed.
+    if errors is 'capture', the BatchReport is returned instead of the list of the results.
+
+    if shared_output is True, the workers write the results of f (arrays of identical shape and type)
+    into an array in shared memory, at the position of their file in paths.
+    The results are not pickled and the returned numpy array of shape (len(paths), *out_shape)
+    uses the shared memory directly (no copy).
+    out_shape and out_dtype are the shape and type of the results of f:
+    if they are not given, they are taken from the result of f on the first file that does not fail.
+    The errors are handled as above (with errors='capture', the results of the report are
+    rows of the shared array), the rows of the failed files are zero.
+    A journal can not be used with shared_output: the results of a previous run are not kept.
     """
 
-    f = _ft.partial(load_and_apply, f=f, **kwargs)
+    if reduce is None:
+        f = _ft.partial(load_and_apply, f=f, **kwargs)
+    else:
+        f = _ft.partial(load_and_reduce, f=f, reduce=reduce, chunk=chunk, **kwargs)
 
     # chose number of used CPUs
-    ncpu = _mp.cpu_count() - 3 if ncpu is None else ncpu
-    ncpu = int(ncpu)
+    ncpu = _batch.default_workers() if ncpu is None else int(ncpu)
 
-    results = None
+    if errors not in ('raise', 'capture'):
+        raise ValueError(f"Unknown errors mode {errors}. Use 'raise' or 'capture'.")
 
-    with _mp.Pool(ncpu) as pool:
-        if progress_bar:
-            results = list(_tqdm(pool.imap(f, paths), total=len(paths), desc=f"Using {ncpu} CPUs"))
-        else:
-            results = pool.map(f, paths)
+    if shared_output:
+        if journal is not None:
+            raise ValueError("A journal can not be used with shared_output.")
+        report, results = _apply_batch_shared(paths, f, ncpu, progress_bar, out_shape, out_dtype,
+                                              executor, chunksize)
+    else:
+        report = _batch.run_batch(paths, f, executor=executor, workers=ncpu, chunksize=chunksize,
+                                  journal=journal, progress_bar=progress_bar)
+        results = None
+    if errors == 'capture':
+        return report
+    report.raise_errors()
+    return report.results if results is None else results
+
+
+def _apply_batch_shared(paths, apply, ncpu, progress_bar, out_shape, out_dtype, executor, chunksize):
+    """Run the batch with the results written in shared memory.
+
+    :return: (BatchReport, the array of the results)
+    """
+    t0 = _time.perf_counter()
+    items = list(enumerate(paths))
+    checked = []
+    first = None
+    if out_shape is None or out_dtype is None:
+        # the shape and type of the results are those of the first file that does not fail
+        while items and first is None:
+            record = _batch._run_item(items.pop(0), apply)
+            checked.append(record)
+            if record.ok:
+                first = _np.asarray(record.result)
+        if first is None:
+            return _batch.BatchReport(checked, wall_time=_time.perf_counter() - t0), None
+        out_shape = first.shape if out_shape is None else out_shape
+        out_dtype = first.dtype if out_dtype is None else out_dtype
+
+    block, results = _shared.create_shared_array((len(paths), *out_shape), out_dtype)
+    if first is not None:
+        results[checked[-1].index] = first
+
+    task = _ft.partial(_apply_to_shared, apply=apply, name=block.name,
+                       shape=results.shape, dtype=results.dtype.str)
+    try:
+        # the items are (index, path): the task writes the result at the index of its file
+        report = _batch.run_batch(items, task, executor=executor, workers=ncpu, chunksize=chunksize,
+                                  progress_bar=progress_bar)
+    finally:
+        # the name is not needed anymore, the memory is released with the results array
+        block.unlink()
 
-    return results
+    for record in report.items:
+        record.index, record.item = record.item
+    records = checked + report.items
+    for record in records:
+        record.result = results[record.index] if record.ok else None
+    return _batch.BatchReport(records, wall_time=_time.perf_counter() - t0), results
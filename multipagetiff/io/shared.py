@@ -0,0 +1,140 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+from multiprocessing import shared_memory as _shared_memory
+import numpy as _np
+from .. import stack as _stack
+
+
+class _SharedBuffer(_np.ndarray):
+    """An array using a block of shared memory.
+
+    The array keeps the block open: the memory is unmapped only when the array
+    (and all the views using it) are deleted.
+    """
+
+
+def _shared_ndarray(block, shape, dtype):
+    holder = _SharedBuffer(shape, dtype=_np.dtype(dtype), buffer=block.buf)
+    holder._block = block
+    return holder.view(_np.ndarray)
+
+
+def create_shared_array(shape, dtype):
+    """Allocate an array in a new block of shared memory.
+
+    :return: (block, array). block.name identifies the block for attach_shared_array,
+        block.unlink() must be called once all the processes have attached it.
+    """
+    nbytes = int(_np.prod(shape)) * _np.dtype(dtype).itemsize
+    block = _shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    return block, _shared_ndarray(block, shape, dtype)
+
+
+def attach_shared_array(name, shape, dtype):
+    """Return an array using the existing block of shared memory called name.
+
+    :return: (block, array)
+    """
+    block = _shared_memory.SharedMemory(name=name)
+    return block, _shared_ndarray(block, shape, dtype)
+
+
+class SharedStack:
+    """A copy of the selected pages of a Stack in shared memory.
+
+    Pickling a SharedStack (e.g. to send it to the workers of a multiprocessing.Pool)
+    only transfers the name of the shared memory block, not the pages:
+    each worker accesses the same pages without copying them.
+
+    Usage:
+        with share_stack(stack) as shared:
+            pool.map(functools.partial(work, shared), items)
+
+        def work(shared, item):
+            stack = shared.stack   # a Stack using the shared pages
+            ...
+
+    The process that created the SharedStack releases the shared memory
+    when close() is called (or at the end of the with block).
+    """
+
+    def __init__(self, stack, chunk=64):
+        first = next(stack.iter_chunks(1))
+        self.shape = (len(stack), *first.shape[1:])
+        self.dtype = first.dtype
+        self._block, pages = create_shared_array(self.shape, self.dtype)
+        i = 0
+        for block in stack.iter_chunks(chunk):
+            pages[i:i+len(block)] = block
+            i += len(block)
+        self.name = self._block.name
+        self.props = dict(dx=stack.dx, dz=stack.dz, title=stack.title,
+                          z_label=stack.z_label, units=stack.units)
+        self._owner = True
+        self._pages = pages
+
+    @property
+    def stack(self):
+        """A Stack whose raw images are the shared pages"""
+        return _stack.Stack(self._pages, **self.props)
+
+    def __getstate__(self):
+        return dict(name=self.name, shape=self.shape, dtype=self.dtype.str, props=self.props)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.dtype = _np.dtype(self.dtype)
+        self._block, self._pages = attach_shared_array(self.name, self.shape, self.dtype)
+        self._owner = False
+
+    def close(self):
+        """Stop using the shared memory (and release it in the process that created it)"""
+        self._pages = None
+        if self._block is None:
+            return
+        if self._owner:
+            self._block.unlink()
+        self._block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return "SharedStack(name={}, shape={}, dtype={})".format(self.name, self.shape, self.dtype)
+
+
+def share_stack(stack, chunk=64):
+    """Copy the selected pages of stack in shared memory.
+
+    The returned SharedStack can be passed to other processes without pickling the pages.
+    see SharedStack
+    """
+    return SharedStack(stack, chunk=chunk)
@@ -0,0 +1,438 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+import copy as _copy
+import re as _re
+import struct as _struct
+import zlib as _zlib
+import numpy as _np
+
+
+class TiffFormatError(ValueError):
+    pass
+
+
+# TIFF tags used to locate and describe the image data of a page
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+IMAGE_DESCRIPTION = 270
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+
+_TAGS = {IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, COMPRESSION, IMAGE_DESCRIPTION,
+         STRIP_OFFSETS, SAMPLES_PER_PIXEL, ROWS_PER_STRIP, STRIP_BYTE_COUNTS,
+         PLANAR_CONFIGURATION, PREDICTOR, TILE_WIDTH, SAMPLE_FORMAT}
+
+# TIFF field type -> (numpy type code, size in bytes)
+_FIELD_TYPES = {1: ('u1', 1), 2: ('S1', 1), 3: ('u2', 2), 4: ('u4', 4), 5: ('u4', 8),
+                6: ('i1', 1), 7: ('u1', 1), 8: ('i2', 2), 9: ('i4', 4), 10: ('i4', 8),
+                11: ('f4', 4), 12: ('f8', 8), 16: ('u8', 8), 17: ('i8', 8), 18: ('u8', 8)}
+
+# TIFF SampleFormat -> numpy kind
+_SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+class TiffPage:
+    """The description of one page (IFD) of a tiff file.
+
+    Only the information needed to locate and interpret the pixel data is kept.
+    """
+
+    def __init__(self, tags, byteorder):
+        self.width = int(tags[IMAGE_WIDTH][0])
+        self.height = int(tags[IMAGE_LENGTH][0])
+        self.samples = int(tags.get(SAMPLES_PER_PIXEL, [1])[0])
+        self.bits = int(tags.get(BITS_PER_SAMPLE, [1])[0])
+        self.compression = int(tags.get(COMPRESSION, [1])[0])
+        self.predictor = int(tags.get(PREDICTOR, [1])[0])
+        self.planar = int(tags.get(PLANAR_CONFIGURATION, [1])[0])
+        self.tiled = TILE_WIDTH in tags
+        self.rows_per_strip = int(tags.get(ROWS_PER_STRIP, [self.height])[0])
+        self.offsets = _np.asarray(tags.get(STRIP_OFFSETS, []), dtype=_np.int64)
+        self.bytecounts = _np.asarray(tags.get(STRIP_BYTE_COUNTS, []), dtype=_np.int64)
+        self.description = tags.get(IMAGE_DESCRIPTION, b'')
+
+        kind = _SAMPLE_KINDS.get(int(tags.get(SAMPLE_FORMAT, [1])[0]))
+        if kind is None or self.bits not in (8, 16, 32, 64):
+            # e.g. bilevel images or complex samples
+            self.dtype = None
+        else:
+            self.dtype = _np.dtype(f"{byteorder}{kind}{self.bits // 8}")
+
+    @property
+    def shape(self):
+        if self.samples > 1:
+            return (self.height, self.width, self.samples)
+        return (self.height, self.width)
+
+    @property
+    def nbytes(self):
+        return self.height * self.width * self.samples * self.bits // 8
+
+    @property
+    def is_raw(self):
+        """True if the pixel data is stored uncompressed and can be read as it is."""
+        return (self.compression == 1 and not self.tiled and self.dtype is not None
+                and (self.samples == 1 or self.planar == 1))
+
+    @property
+    def is_contiguous(self):
+        """True if the (uncompressed) strips of this page are stored one after the other."""
+        if not self.is_raw or len(self.offsets) == 0:
+            return False
+        ends = self.offsets[:-1] + self.bytecounts[:-1]
+        return bool((ends == self.offsets[1:]).all()) and int(self.bytecounts.sum()) >= self.nbytes
+
+    @property
+    def is_deflate(self):
+        """True if the pixel data is stored in deflate compressed strips, without predictor."""
+        return (self.compression in (8, 32946) and self.predictor == 1 and not self.tiled
+                and self.dtype is not None and (self.samples == 1 or self.planar == 1)
+                and len(self.offsets) > 0)
+
+    def inflate(self, fh):
+        """Read and decompress the pixel data of a deflate compressed page from the open file fh"""
+        data = bytearray()
+        for offset, count in zip(self.offsets, self.bytecounts):
+            fh.seek(int(offset))
+            data += _zlib.decompress(fh.read(int(count)))
+        return _np.frombuffer(data, dtype=self.dtype, count=self.nbytes // self.dtype.itemsize).reshape(self.shape)
+
+    @property
+    def data_offset(self):
+        return int(self.offsets[0])
+
+    def same_layout(self, other):
+        return self.shape == other.shape and self.dtype == other.dtype
+
+
+class TiffIndex:
+    """Index of the pages of a tiff file.
+
+    The chain of IFDs is parsed once, without decoding any image data.
+    Classic TIFF and BigTIFF files in both byte orders are supported.
+
+    Usage:
+        index = TiffIndex(path)
+        len(index)          # number of pages
+        index.memmap()      # the pages as a memory mapped array (uncompressed files only)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fh:
+            self._parse(fh)
+
+    def _parse(self, fh):
+        header = fh.read(16)
+        if header[:2] == b'II':
+            bo = '<'
+        elif header[:2] == b'MM':
+            bo = '>'
+        else:
+            raise TiffFormatError(f"{self.path} is not a tiff file.")
+
+        version = _struct.unpack(bo + 'H', header[2:4])[0]
+        if version == 42:
+            count_fmt, entry_size, offset_fmt = 'H', 12, 'I'
+            next_ifd = _struct.unpack(bo + 'I', header[4:8])[0]
+        elif version == 43:
+            count_fmt, entry_size, offset_fmt = 'Q', 20, 'Q'
+            next_ifd = _struct.unpack(bo + 'Q', header[8:16])[0]
+        else:
+            raise TiffFormatError(f"{self.path} is not a tiff file.")
+
+        self.byteorder = bo
+        self.bigtiff = version == 43
+        count_size = _struct.calcsize(count_fmt)
+        offset_size = _struct.calcsize(offset_fmt)
+        entry_fmt = bo + 'HH' + offset_fmt + f'{offset_size}s'
+
+        pages = []
+        visited = set()
+        while next_ifd and next_ifd not in visited:
+            visited.add(next_ifd)
+            fh.seek(next_ifd)
+            n_entries = _struct.unpack(bo + count_fmt, fh.read(count_size))[0]
+            raw = fh.read(n_entries * entry_size + offset_size)
+            if len(raw) < n_entries * entry_size + offset_size:
+                # truncated file: keep the pages read so far
+                break
+            tags = {}
+            for k in range(n_entries):
+                tag, ftype, count, value = _struct.unpack_from(entry_fmt, raw, k * entry_size)
+                if tag in _TAGS and ftype in _FIELD_TYPES:
+                    tags[tag] = self._read_value(fh, ftype, count, value, offset_size)
+            pages.append(TiffPage(tags, bo))
+            next_ifd = _struct.unpack_from(bo + offset_fmt, raw, n_entries * entry_size)[0]
+
+        if len(pages) == 0:
+            raise TiffFormatError(f"{self.path} does not contain any page.")
+
+        self.pages = pages
+        self.n_pages = len(pages)
+        self._imagej_pages()
+
+    def _read_value(self, fh, ftype, count, value, offset_size):
+        code, size = _FIELD_TYPES[ftype]
+        nbytes = size * count
+        if nbytes <= offset_size:
+            data = value[:nbytes]
+        else:
+            pos = fh.tell()
+            fh.seek(_struct.unpack(self.byteorder + ('I' if offset_size == 4 else 'Q'), value)[0])
+            data = fh.read(nbytes)
+            fh.seek(pos)
+        if ftype == 2:
+            return data.rstrip(b'\x00')
+        values = _np.frombuffer(data, dtype=self.byteorder + code)
+        if ftype in (5, 10):
+            values = values[0::2] / values[1::2]
+        return values
+
+    def _imagej_pages(self):
+        """ImageJ stores stacks larger than 4GB with a single IFD followed by all the pages."""
+        page = self.pages[0]
+        if self.n_pages != 1 or not page.is_contiguous:
+            return
+        match = _re.search(rb'images=(\d+)', page.description) \
+            if page.description.startswith(b'ImageJ=') else None
+        if match is not None and int(match.group(1)) > 1:
+            self.n_pages = int(match.group(1))
+            self._imagej = True
+
+    def __len__(self):
+        return self.n_pages
+
+    def page(self, i):
+        """The description of the i-th page"""
+        if getattr(self, '_imagej', False):
+            # the pages are described by the first IFD, their data follows the first page
+            i = range(self.n_pages)[i]
+            first = self.pages[0]
+            page = _copy.copy(first)
+            page.offsets = first.offsets + i * first.nbytes
+            return page
+        return self.pages[i]
+
+    @property
+    def page_offsets(self):
+        """The file offset of the image data of each page"""
+        if getattr(self, '_imagej', False):
+            first = self.pages[0]
+            return first.data_offset + _np.arange(self.n_pages, dtype=_np.int64) * first.nbytes
+        return _np.array([p.data_offset for p in self.pages], dtype=_np.int64)
+
+    @property
+    def is_memmappable(self):
+        """True if all the pages are uncompressed, contiguous, have the same
+        shape and type and are evenly spaced in the file."""
+        first = self.pages[0]
+        if not all(p.is_contiguous and p.same_layout(first) for p in self.pages):
+            return False
+        offsets = self.page_offsets
+        return len(offsets) < 2 or bool((_np.diff(offsets) == offsets[1] - offsets[0]).all()) \
+            and offsets[1] > offsets[0]
+
+    def memmap(self, mode='c'):
+        """Return the pages as an array backed by a memory map of the file.
+
+        No image data is read: pages are loaded by the OS when accessed.
+        The default mode 'c' (copy on write) allows to modify the array in memory,
+        the file is never modified.
+
+        :param mode: the memory map mode (see numpy.memmap)
+        :return: an array of shape (n, h, w) or (n, h, w, samples)
+        """
+        if not self.is_memmappable:
+            raise TiffFormatError(f"The pages of {self.path} can not be memory mapped.")
+
+        first = self.pages[0]
+        offsets = self.page_offsets
+        stride = int(offsets[1] - offsets[0]) if len(offsets) > 1 else first.nbytes
+        span = stride * (len(offsets) - 1) + first.nbytes
+        mm = _np.memmap(self.path, dtype=_np.uint8, mode=mode, offset=int(offsets[0]), shape=(span,))
+
+        shape = (len(offsets), *first.shape)
+        strides = [stride]
+        item_strides = [first.dtype.itemsize]
+        for n in reversed(first.shape[1:]):
+            item_strides.insert(0, item_strides[0] * n)
+        return _np.ndarray(shape, dtype=first.dtype, buffer=mm, strides=strides + item_strides)
+
+
+def mapped_filename(ndarray):
+    """Return the name of the file memory-mapped by ndarray (or one of its bases), if any."""
+    while ndarray is not None:
+        if isinstance(ndarray, _np.memmap) and ndarray.filename is not None:
+            return ndarray.filename
+        ndarray = getattr(ndarray, 'base', None)
+    return None
+
+
+COMPRESSIONS = {None: 1, 'none': 1, 'deflate': 8, 'zlib': 8}
+
+# numpy kind -> TIFF SampleFormat
+_SAMPLE_FORMATS = {'u': 1, 'b': 1, 'i': 2, 'f': 3}
+
+# the largest classic TIFF, with some room for the IFDs
+CLASSIC_TIFF_LIMIT = 2**32 - 2**25
+
+
+class TiffWriter:
+    """Write a tiff file one page at a time.
+
+    Each page is written as a single strip followed by its IFD,
+    so that nothing but the current page is kept in memory.
+    Uncompressed pages of the same shape are evenly spaced in the file
+    and can be memory mapped by TiffIndex.
+
+    Usage:
+        with TiffWriter(path, bigtiff=False) as tw:
+            for page in pages:
+                tw.write(page)
+    """
+
+    def __init__(self, path, bigtiff=False):
+        self.path = path
+        self.bigtiff = bigtiff
+        self._fh = open(path, 'wb')
+        if bigtiff:
+            self._offset_fmt, self._count_fmt, self._entry_size = 'Q', 'Q', 20
+            self._fh.write(b'II' + _struct.pack('<HHHQ', 43, 8, 0, 0))
+            self._next_ifd_pos = 8
+        else:
+            self._offset_fmt, self._count_fmt, self._entry_size = 'I', 'H', 12
+            self._fh.write(b'II' + _struct.pack('<HI', 42, 0))
+            self._next_ifd_pos = 4
+        self._offset_size = _struct.calcsize(self._offset_fmt)
+
+    @staticmethod
+    def prepare(page):
+        """Return page as a contiguous little-endian array of a type supported by TIFF."""
+        page = _np.asarray(page)
+        if page.ndim not in (2, 3):
+            raise ValueError("Pages must be 2D (h, w) or 3D (h, w, samples) arrays.")
+        if page.dtype.kind == 'b':
+            page = page.astype(_np.uint8)
+        elif page.dtype.kind == 'f' and page.dtype.itemsize < 4:
+            page = page.astype(_np.float32)
+        elif page.dtype.kind not in _SAMPLE_FORMATS:
+            raise TypeError(f"Pages of type {page.dtype} can not be written to a tiff file.")
+        return _np.ascontiguousarray(page, dtype=page.dtype.newbyteorder('<'))
+
+    @staticmethod
+    def encode(page, compression=None, level=6):
+        """Return the bytes of a prepared page, compressed if required"""
+        if COMPRESSIONS[compression] == 8:
+            return _zlib.compress(page, level)
+        return memoryview(page).cast('B')
+
+    def write(self, page, compression=None, level=6):
+        """Prepare, encode and write a page"""
+        page = self.prepare(page)
+        self.write_encoded(page, self.encode(page, compression, level), compression)
+
+    def write_encoded(self, page, data, compression=None):
+        """Write the (encoded) data of a prepared page, followed by its IFD"""
+        fh = self._fh
+        self._align()
+        data_pos = fh.tell()
+        fh.write(data)
+        self._align()
+        ifd_pos = fh.tell()
+
+        samples = page.shape[2] if page.ndim == 3 else 1
+        rgb = samples in (3, 4) and page.dtype == _np.uint8
+        offset_type = 16 if self.bigtiff else 4
+        entries = [
+            (IMAGE_WIDTH, 4, [page.shape[1]]),
+            (IMAGE_LENGTH, 4, [page.shape[0]]),
+            (BITS_PER_SAMPLE, 3, [page.dtype.itemsize * 8] * samples),
+            (COMPRESSION, 3, [COMPRESSIONS[compression]]),
+            (262, 3, [2 if rgb else 1]),   # PhotometricInterpretation
+            (STRIP_OFFSETS, offset_type, [data_pos]),
+            (SAMPLES_PER_PIXEL, 3, [samples]),
+            (ROWS_PER_STRIP, 4, [page.shape[0]]),
+            (STRIP_BYTE_COUNTS, offset_type, [len(data)]),
+            (PLANAR_CONFIGURATION, 3, [1]),
+        ]
+        extra = samples - (3 if rgb else 1)
+        if extra > 0:
+            # ExtraSamples: unassociated alpha for RGBA, unspecified otherwise
+            entries.append((338, 3, [2 if rgb else 0] * extra))
+        entries.append((SAMPLE_FORMAT, 3, [_SAMPLE_FORMATS[page.dtype.kind]] * samples))
+
+        fh.write(self._pack_ifd(entries, ifd_pos))
+
+        # link the previous IFD (or the header) to this one
+        fh.seek(self._next_ifd_pos)
+        fh.write(_struct.pack('<' + self._offset_fmt, ifd_pos))
+        fh.seek(0, 2)
+        self._next_ifd_pos = ifd_pos + _struct.calcsize(self._count_fmt) + len(entries) * self._entry_size
+
+    def _pack_ifd(self, entries, ifd_pos):
+        count_size = _struct.calcsize(self._count_fmt)
+        external_pos = ifd_pos + count_size + len(entries) * self._entry_size + self._offset_size
+        ifd = [_struct.pack('<' + self._count_fmt, len(entries))]
+        external = []
+        for tag, ftype, values in entries:
+            value = _np.asarray(values, dtype='<' + _FIELD_TYPES[ftype][0]).tobytes()
+            if len(value) <= self._offset_size:
+                value = value.ljust(self._offset_size, b'\x00')
+            else:
+                offset = external_pos + sum(len(v) for v in external)
+                external.append(value + b'\x00' * (len(value) % 2))
+                value = _struct.pack('<' + self._offset_fmt, offset)
+            ifd.append(_struct.pack('<HH' + self._offset_fmt, tag, ftype, len(values)) + value)
+        # next IFD offset, patched when the next page is written
+        ifd.append(b'\x00' * self._offset_size)
+        return b''.join(ifd + external)
+
+    def _align(self):
+        if self._fh.tell() % 2:
+            self._fh.write(b'\x00')
+
+    def close(self):
+        if not self.bigtiff and self._fh.tell() >= 2**32:
+            self._fh.close()
+            raise TiffFormatError("The file is larger than 4GB: use bigtiff=True.")
+        self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,57 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+from collections import deque as _deque
+from concurrent import futures as _futures
+
+
+def ordered_map(f, items, workers=None, executor='thread'):
+    """Yield f(item) for each item, in the order of the items.
+
+    If workers > 1, the calls run on a pool of threads (or processes), and the items are
+    consumed as the results are yielded: at most 2*workers items are pending at any time,
+    so that a stream of large items (e.g. chunks of pages) is not loaded in memory at once.
+
+    :param workers: number of threads or processes (default: 1, no pool)
+    :param executor: 'thread' or 'process' (f, the items and the results must be picklable)
+    """
+    if executor not in ('thread', 'process'):
+        raise ValueError(f"Unknown executor {executor}. Use 'thread' or 'process'.")
+    if workers is None or workers <= 1:
+        for item in items:
+            yield f(item)
+        return
+
+    pool = _futures.ThreadPoolExecutor if executor == 'thread' else _futures.ProcessPoolExecutor
+    with pool(workers) as ex:
+        pending = _deque()
+        for item in items:
+            pending.append(ex.submit(f, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
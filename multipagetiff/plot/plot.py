@@ -31,18 +31,45 @@ from matplotlib import pyplot as _plt
 from matplotlib import colorbar, colors
 import numpy as _np
 from ..stacktools import _get_orthogonal_slices
+from ..stacktools.projection import project_pairs as _project_pairs
 
 
-def plot_selection(stack, page=None, plot_axis=None, **kwargs):
+def _display_scale(ax, shape):
+    """Number of displayed pixels per pixel of an image of shape (rows, columns) in ax"""
+    bbox = ax.get_window_extent()
+    return min(bbox.width / shape[1], bbox.height / shape[0])
+
+
+def _preview_level(pyramid, ax, shape):
+    """The coarsest level of pyramid which still fills ax (for an image of the given full resolution shape)"""
+    return pyramid.select(_display_scale(ax, shape))
+
+
+def _imshow(ax, img, factors=(1, 1), **kwargs):
+    """imshow an image binned by factors (rows, columns), in the coordinates of the full resolution image"""
+    if factors != (1, 1):
+        kwargs.setdefault('extent', (-0.5, img.shape[1] * factors[1] - 0.5, img.shape[0] * factors[0] - 0.5, -0.5))
+    return ax.imshow(img, **kwargs)
+
+
+def plot_selection(stack, page=None, plot_axis=None, preview=True, **kwargs):
     """Plot the crop region over a raw image of the stack
 
-    if page is None the stack is z-projected"""
+    if page is None the stack is z-projected
+    if preview is True, a binned version of the raw images that fills the axes is used"""
     plot_axis = _plt.gca if plot_axis is None else plot_axis
-    if page is None:
-        img = stack._imgs.max(axis=0)
+    k, f = 0, (1, 1)
+    if preview:
+        pyramid = stack.build_pyramid(raw=True)
+        k = _preview_level(pyramid, _plt.gca(), stack._imgs.shape[1:])
+        f = pyramid.factors(k)[1:]
+    if k == 0:
+        img = stack._imgs.max(axis=0) if page is None else stack._imgs[page]
+    elif page is None:
+        img = pyramid.level(k).max(axis=0)
     else:
-        img = stack._imgs[page]
-    _plt.imshow(img)
+        img = pyramid.page(page, k)
+    _imshow(_plt.gca(), img, f)
     r0, r1, c0, c1 = stack._crop[2:]
     fill = kwargs.get("fill", False)
     edgecolor = kwargs.get("edgecolor", 'red')
@@ -70,44 +97,103 @@ def set_cmap(cmap):
     _config.cmap = cmap
 
 
-def color_code_ndarray(ndarray, threshold=0, axis=0):
-    cmap = get_cmap()
+def _depth_lut(n):
+    """Return the (n, 3) table of the RGB colors of the pages of a stack of n pages."""
+    return get_cmap()(_np.arange(n) / n)[:, :3]
+
+
+def _color_code_block(block, colors, threshold=0, dtype=_np.float64):
+    """Color code a block of pages.
+
+    Each page is normalized between its min and max, then multiplied by its color.
+    :param block: array of shape (n, h, w)
+    :param colors: (n, 3) table of the colors of the pages of the block
+    :param dtype: output type. Floating types are in [0, 1],
+        integer types are scaled to their maximum value.
+    :return: array of shape (n, h, w, 3)
+    """
+    dtype = _np.dtype(dtype)
+
+    block_min = block.min(axis=(1, 2))
+    block_range = block.max(axis=(1, 2)) - block_min
+    nonzero = block_range != 0
+    # constant pages are not normalized
+    block_min = _np.where(nonzero, block_min, 0).astype(block.dtype)
+    block_range = _np.where(nonzero, block_range, 1)
 
-    s = ndarray.shape[0]
+    img = (block - block_min[:, None, None]) / block_range[:, None, None]
+    img[img < threshold] = 0
 
-    rgb = _np.zeros((*ndarray.shape, 3))
-    for i, img in enumerate(ndarray):
-        img_min = img.min()
-        img_max = img.max()
-        img_c = img_max - img_min
-        if (img_c != 0):
-            img = (img-img_min)/img_c
-        img[img < threshold] = 0
-        j = i/s
-        rgb[i, :, :, 0] = img*cmap(j)[0]
-        rgb[i, :, :, 1] = img*cmap(j)[1]
-        rgb[i, :, :, 2] = img*cmap(j)[2]
+    if dtype.kind == 'f':
+        return img.astype(dtype, copy=False)[..., None] * colors.astype(dtype)[:, None, None, :]
 
-    return rgb
+    rgb = img.astype(_np.float32, copy=False)[..., None] * colors.astype(_np.float32)[:, None, None, :]
+    rgb *= _np.iinfo(dtype).max
+    _np.clip(rgb, 0, _np.iinfo(dtype).max, out=rgb)
+    return _np.rint(rgb, out=rgb).astype(dtype)
 
 
-def color_code(stack, threshold=0, axis=0):
+def color_code_ndarray(ndarray, threshold=0, axis=0, dtype=_np.float64, chunk_pages=16, out=None):
+    """Color code the pages of a 3D array according to their depth.
+
+    The pages are processed by blocks of chunk_pages pages,
+    so that the temporary memory is bounded by the size of a block.
+
+    :param ndarray: array of shape (n, h, w)
+    :param threshold: [0,1] intensity values below the threshold are set to zero
+    :param dtype: the type of the output (e.g. float64, float32 or uint8)
+    :param chunk_pages: number of pages processed at once
+    :param out: optional preallocated output of shape (n, h, w, 3), e.g. a numpy.memmap
+    :return: a rgb multipage image (numpy array of shape (n, h, w, 3))
+    """
+    return _color_code_chunks(_iter_blocks(ndarray, chunk_pages), len(ndarray),
+                              ndarray.shape[1:], threshold, dtype, out)
+
+
+def _iter_blocks(ndarray, n):
+    for i in range(0, len(ndarray), n):
+        yield ndarray[i:i+n]
+
+
+def _color_code_chunks(chunks, n_pages, page_shape, threshold=0, dtype=_np.float64, out=None):
+    """Color code consecutive blocks of pages into out (see color_code_ndarray)"""
+    if out is None:
+        out = _np.empty((n_pages, *page_shape, 3), dtype=dtype)
+    elif out.shape != (n_pages, *page_shape, 3):
+        raise ValueError(f"out must have shape {(n_pages, *page_shape, 3)}")
+
+    colors = _depth_lut(n_pages)
+    i = 0
+    for block in chunks:
+        j = i + len(block)
+        out[i:j] = _color_code_block(block, colors[i:j], threshold, out.dtype)
+        i = j
+
+    return out
+
+
+def color_code(stack, threshold=0, axis=0, dtype=_np.float64, chunk_pages=16, out=None):
     """
     Color code the pages of a multipage grayscale tiff image
     :param stack:
     :param threshold: [0,1] intensity values below the threshold are set to zero
+    :param dtype: the type of the output (e.g. float64, float32 or uint8)
+    :param chunk_pages: number of pages processed at once
+    :param out: optional preallocated output (e.g. a numpy.memmap for stacks larger than memory)
     :return: a rgb multipage image (numpy array)
     """
 
-    selection = stack.pages.copy()
+    if axis == 0:
+        # stream the pages of the stack
+        return _color_code_chunks(stack.iter_chunks(chunk_pages), len(stack), stack[0].shape,
+                                  threshold, dtype, out)
 
     # rotate the array
-    if axis != 0:
-        selection = _np.rot90(selection, axes=(0, axis))
+    selection = _np.rot90(stack.pages, axes=(0, axis))
     if axis == 2:
         selection = _np.rot90(selection, axes=(2, 1))
 
-    return color_code_ndarray(selection, threshold, axis)
+    return color_code_ndarray(selection, threshold, axis, dtype, chunk_pages, out)
 
 
 def flatten_grayscale(stack, axis=0):
@@ -116,7 +202,20 @@ def flatten_grayscale(stack, axis=0):
     vertical = 1
     horizontal = 2
     """
-    return stack[:].max(axis=axis)
+    return _project_pairs(stack, [('max', axis)])['max', axis]
+
+
+def _depth_color(img, idx, page_min, page_max, lut, threshold=0):
+    """Color code a max projection img, whose values come from the pages idx"""
+    # normalize each max by the range of the page it comes from,
+    # as color_code_ndarray does for the whole page
+    page_range = page_max - page_min
+    img_c = page_range[idx]
+    nonzero = img_c != 0
+    img = _np.where(nonzero, (img - page_min[idx]) / _np.where(nonzero, img_c, 1), img)
+    img[img < threshold] = 0
+
+    return img[..., _np.newaxis] * lut[idx]
 
 
 def flatten(stack, threshold=0, axis=0, rotate_axis_2=False):
@@ -130,21 +229,18 @@ def flatten(stack, threshold=0, axis=0, rotate_axis_2=False):
     :param threshold: [0,1] intensity values below the threshold are set to zero
     :return: a numpy array
     """
-    imgs = stack.pages.copy()
-    # imgs = imgs.swapaxes(axis, 0)
-    if axis != 0:
-        imgs = _np.rot90(imgs, axes=(0, axis))
-    if (axis == 2) and rotate_axis_2:
-        imgs = _np.rot90(imgs, axes=(2, 1))
-    idx = _np.argmax(imgs, axis=0)
-    # the output rgb image
-    rgb = color_code_ndarray(imgs, threshold=threshold, axis=axis)
-    out = _np.zeros((*rgb.shape[1:3], 3))
-
-    for i in range(out.shape[0]):
-        for j in range(out.shape[1]):
-            out[i, j, :] = rgb[idx[i, j], i, j]
-    return out
+    if axis == 0:
+        # the pages are streamed
+        imgs = stack
+    else:
+        imgs = _np.rot90(_np.asarray(stack.pages), axes=(0, axis))
+        if (axis == 2) and rotate_axis_2:
+            imgs = _np.rot90(imgs, axes=(2, 1))
+
+    # depth and value of the maximum of each pixel, and range of each page, in one pass
+    p = _project_pairs(imgs, [('max', 0), ('argmax', 0), ('min', 1), ('max', 1)])
+    return _depth_color(p['max', 0], p['argmax', 0], p['min', 1].min(axis=1), p['max', 1].max(axis=1),
+                        _depth_lut(len(imgs)), threshold)
 
 
 def plot_flatten(stack, threshold=0, axis=0):
@@ -176,7 +272,7 @@ def plot_flatten(stack, threshold=0, axis=0):
         norm = colors.Normalize(
             vmin=stack.range_in_units[0], vmax=stack.range_in_units[1])
     else:
-        s = stack.pages.shape[axis]/2
+        s = stack.shape[axis]/2
         norm = colors.Normalize(
             vmin=-s*stack.dx, vmax=s*stack.dx,)
     cb1 = colorbar.ColorbarBase(ax2, cmap=get_cmap(),
@@ -189,26 +285,22 @@ def plot_flatten(stack, threshold=0, axis=0):
         cb1.set_label("{} [{}]".format(stack.z_label, stack.units))
 
 
-def plot_pages(stack, pages=None, colorcoded=False, **kwargs):
+def plot_pages(stack, pages=None, colorcoded=False, preview=True, **kwargs):
     """
     Plot the pages of the stack.
     :param stack:
     :param colorcoded: the stack is color coded
     :param pages: list of integer indicating the pages to plot
+    :param preview: plot binned pages that still fill the axes (see Stack.build_pyramid)
     :return: None
     """
-    if colorcoded:
-        imgs = color_code(stack)
-    else:
-        imgs = stack.pages
-
     if pages is not None:
         try:
             iter(pages)
         except TypeError:
             raise TypeError("pages must be an iterable.")
     else:
-        pages = range(len(imgs))
+        pages = range(len(stack))
 
     if len(pages) > _config.n_max_img_plot:
         pages = pages[:_config.n_max_img_plot]
@@ -218,12 +310,23 @@ def plot_pages(stack, pages=None, colorcoded=False, **kwargs):
     cols = min(n_imgs, 6)
     rows = min(6, int(_np.floor(n_imgs/cols))+1)
 
+    # only the plotted pages are color coded
+    colors = _depth_lut(len(stack)) if colorcoded else None
+    page_shape = stack.shape[1:]
+
     for j, i in enumerate(pages):
-        img = imgs[i]
-        _plt.subplot(rows, cols, j+1)
-        _plt.imshow(img, **kwargs)
+        ax = _plt.subplot(rows, cols, j+1)
+        k, f = 0, (1, 1)
+        if preview:
+            pyramid = stack.build_pyramid()
+            k = _preview_level(pyramid, ax, page_shape)
+            f = pyramid.factors(k)[1:]
+        img = stack[i] if k == 0 else pyramid.page(i, k)
+        if colorcoded:
+            img = _color_code_block(img[_np.newaxis], colors[i:i+1])[0]
+        _imshow(ax, img, f, **kwargs)
         _plt.axis('off')
-        _plt.text(0.05*img.shape[0], 0.9*img.shape[1], str(i),
+        _plt.text(0.05*page_shape[0], 0.9*page_shape[1], str(i),
                   {'bbox': dict(boxstyle="round", fc="white", ec="gray", pad=0.1)})
 
     _plt.tight_layout()
@@ -260,7 +363,7 @@ def get_xz_color_coded(stack, y, x=None, length=None, interpolation=1):
     return xz
 
 
-def orthogonal_views(stack, v=None, h=None, z=None, **kwargs):
+def orthogonal_views(stack, v=None, h=None, z=None, preview=True, **kwargs):
     """
     Plot orthogonal planes intersecting at the specified point.
 
@@ -271,6 +374,8 @@ def orthogonal_views(stack, v=None, h=None, z=None, **kwargs):
     **kwargs are forwarded to the pyplot.imshow function
 
     if a coordinate is missing, the center of that dimension is used.
+    if preview is True, the planes are taken from a binned version of the stack that
+    still fills the axes (see Stack.build_pyramid).
 
     """
 
@@ -280,18 +385,29 @@ def orthogonal_views(stack, v=None, h=None, z=None, **kwargs):
     point = _np.array([z, v, h])
 
     # the default point is in the middle of the stack
-    default_point = (_np.array(stack[:].shape)//2).astype(int)
+    default_point = (_np.array(stack.shape)//2).astype(int)
     # set default for unspecified coordinates
     for i in range(len(point)):
         if point[i] is None:
             point[i] = default_point[i]
 
-    orto = _get_orthogonal_slices(stack, *point)
-
     ax = fig.add_subplot(gs1[0])
+    fz, fy, fx = 1, 1, 1
+    if preview:
+        pyramid = stack.build_pyramid()
+        k = _preview_level(pyramid, ax, stack.shape[1:])
+        fz, fy, fx = pyramid.factors(k)
+    if (fz, fy, fx) == (1, 1, 1):
+        orto = _get_orthogonal_slices(stack, *point)
+    else:
+        vol = pyramid.level(k)
+        zb, vb, hb = (min(int(p) // f, n - 1) for p, f, n in zip(point, (fz, fy, fx), vol.shape))
+        orto = dict(vh=vol[zb], zv=vol[:, :, hb], zh=vol[:, vb, :])
+    factors = dict(vh=(fy, fx), zv=(fz, fy), zh=(fz, fx))
+
     av = 'v'
     ah = 'h'
-    ax.imshow(orto[f'{av}{ah}'], **kwargs)
+    _imshow(ax, orto[f'{av}{ah}'], factors[f'{av}{ah}'], **kwargs)
     ax.scatter(h, v, facecolors='none', edgecolors='red')
     ax.set_ylabel(av)
     ax.set_xlabel(ah)
@@ -299,7 +415,7 @@ def orthogonal_views(stack, v=None, h=None, z=None, **kwargs):
     ax = fig.add_subplot(gs1[1])
     av = 'z'
     ah = 'v'
-    ax.imshow(orto[f'{av}{ah}'], **kwargs)
+    _imshow(ax, orto[f'{av}{ah}'], factors[f'{av}{ah}'], **kwargs)
     ax.scatter(v, z, facecolors='none', edgecolors='red')
     ax.set_ylabel(av)
     ax.set_xlabel(ah)
@@ -307,7 +423,7 @@ def orthogonal_views(stack, v=None, h=None, z=None, **kwargs):
     ax = fig.add_subplot(gs1[2])
     av = 'z'
     ah = 'h'
-    ax.imshow(orto[f'{av}{ah}'], **kwargs)
+    _imshow(ax, orto[f'{av}{ah}'], factors[f'{av}{ah}'], **kwargs)
     ax.scatter(h, z, facecolors='none', edgecolors='red')
     ax.set_ylabel(av)
     ax.set_xlabel(ah)
@@ -315,20 +431,54 @@ def orthogonal_views(stack, v=None, h=None, z=None, **kwargs):
     _plt.tight_layout()
 
 
-def orthogonal_project(stack, depth_color_coded=False, **kwargs):
+def _flatten_projections(p, axis, shape):
+    """The color-coded max projection along axis (as flatten) from the projections p of the stack"""
+    if axis == 0:
+        return _depth_color(p['max', 0], p['argmax', 0], p['min', 1].min(axis=1), p['max', 1].max(axis=1),
+                            _depth_lut(shape[0]), 0)
+    # flatten rotates the stack: the pages are in reversed order
+    other = 2 if axis == 1 else 1
+    n = shape[axis]
+    img = _depth_color(p['max', axis], n - 1 - p['argmax', axis], p['min', other].min(axis=0)[::-1],
+                       p['max', other].max(axis=0)[::-1], _depth_lut(n), 0)
+    return img if axis == 1 else img.transpose(1, 0, 2)
+
+
+def orthogonal_project(stack, depth_color_coded=False, preview=True, workers=None, **kwargs):
+    """Plot the projections of the stack along its three axes.
+
+    The three projections are computed in one pass over the data (see stacktools.project).
+    if preview is True, the projections are computed on a binned version of the stack
+    that still fills the axes (see Stack.build_pyramid).
+    """
     fig = _plt.gcf()
     gs1 = _gridspec.GridSpec(2, 2)
 
     axis_names = ('yx', 'zx', 'zy')
-
-    for i in range(3):
-        ax = fig.add_subplot(gs1[i])
+    axes = [fig.add_subplot(gs1[i]) for i in range(3)]
+
+    source, fz, fy, fx = stack, 1, 1, 1
+    if preview:
+        pyramid = stack.build_pyramid()
+        k = _preview_level(pyramid, axes[0], stack.shape[1:])
+        if k > 0:
+            fz, fy, fx = pyramid.factors(k)
+            source = pyramid.level(k)
+
+    pairs = [('max', i) for i in range(3)]
+    if depth_color_coded:
+        pairs += [('argmax', i) for i in range(3)] + [('min', 1), ('min', 2)]
+    # flatten reverses the axes 1 and 2: the last maximum along them is kept
+    projections = _project_pairs(source, pairs, workers=workers, last=(1, 2))
+
+    for i, ax in enumerate(axes):
         if depth_color_coded:
-            img = flatten(stack, axis=i)
+            img = _flatten_projections(projections, i, source.shape)
         else:
-            img = flatten_grayscale(stack, axis=i)
+            img = projections['max', i]
 
-        ax.imshow(img, **kwargs)
+        factors = [(fy, fx), (fz, fx), (fy, fz) if depth_color_coded else (fz, fy)][i]
+        _imshow(ax, img, factors, **kwargs)
         ax.set_ylabel(axis_names[i][0])
         ax.set_xlabel(axis_names[i][1])
 
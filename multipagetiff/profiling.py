@@ -0,0 +1,212 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+Opt-in instrumentation.
+
+When config.profiling is True, the I/O functions, the recomputation of Stack.pages,
+the normalization, the projections and the transforms emit an Event
+(wall time, pages and bytes processed, cache hits, bytes allocated)
+to the sinks in config.profiling_sink (by default the in-memory counters of this module).
+
+A sink is any callable taking an Event: see Counters, LoggingSink,
+or use a function as a callback.
+"""
+
+import logging as _logging
+import time as _time
+from collections import OrderedDict as _OrderedDict
+from .config import config as _config
+
+
+class Event:
+    """A measure of one operation.
+
+    name: the name of the operation (e.g. 'io.read_stack')
+    seconds: wall time
+    pages, nbytes: the number of pages and bytes processed
+    allocated: the bytes of the arrays allocated for the result
+    cache: 'hit', 'miss' or None if the operation is not cached
+    details: other information about the operation
+    """
+
+    __slots__ = ('name', 'seconds', 'pages', 'nbytes', 'allocated', 'cache', 'details')
+
+    def __init__(self, name, seconds=0., pages=0, nbytes=0, allocated=0, cache=None, **details):
+        self.name = name
+        self.seconds = seconds
+        self.pages = pages
+        self.nbytes = nbytes
+        self.allocated = allocated
+        self.cache = cache
+        self.details = details
+
+    def data(self, array, pages=None, allocated=True):
+        """Count the pages and bytes of array (and its bytes as allocated).
+
+        :param pages: the number of pages of array (default: its length, for a stack of pages)
+        """
+        self.pages += len(array) if pages is None else pages
+        nbytes = int(getattr(array, 'nbytes', 0))
+        self.nbytes += nbytes
+        if allocated:
+            self.allocated += nbytes
+        return array
+
+    def __repr__(self):
+        cache = '' if self.cache is None else f', cache={self.cache}'
+        details = ''.join(f', {k}={v}' for k, v in self.details.items())
+        return "Event({}, {:.6f} s, pages={}, nbytes={}, allocated={}{}{})".format(
+            self.name, self.seconds, self.pages, self.nbytes, self.allocated, cache, details)
+
+
+class Counters:
+    """A sink aggregating the events by name, in memory."""
+
+    FIELDS = ('calls', 'seconds', 'pages', 'nbytes', 'allocated', 'hits', 'misses')
+
+    def __init__(self):
+        self._totals = _OrderedDict()
+
+    def __call__(self, event):
+        totals = self._totals.get(event.name)
+        if totals is None:
+            totals = self._totals[event.name] = dict.fromkeys(self.FIELDS, 0)
+        totals['calls'] += 1
+        totals['seconds'] += event.seconds
+        totals['pages'] += event.pages
+        totals['nbytes'] += event.nbytes
+        totals['allocated'] += event.allocated
+        if event.cache == 'hit':
+            totals['hits'] += 1
+        elif event.cache == 'miss':
+            totals['misses'] += 1
+
+    def __getitem__(self, name):
+        return dict(self._totals[name])
+
+    def __contains__(self, name):
+        return name in self._totals
+
+    def summary(self):
+        """The totals of each operation, as a dict {name: {field: total}}"""
+        return {name: dict(totals) for name, totals in self._totals.items()}
+
+    def reset(self):
+        self._totals.clear()
+
+    def __repr__(self):
+        lines = ["{:28s} {:>7s} {:>10s} {:>8s} {:>10s} {:>10s} {:>6s} {:>6s}".format(
+            'operation', 'calls', 'seconds', 'pages', 'MB', 'alloc MB', 'hits', 'misses')]
+        for name, t in self._totals.items():
+            lines.append("{:28s} {:7d} {:10.4f} {:8d} {:10.1f} {:10.1f} {:6d} {:6d}".format(
+                name, t['calls'], t['seconds'], t['pages'], t['nbytes'] / 2**20, t['allocated'] / 2**20,
+                t['hits'], t['misses']))
+        return '\n'.join(lines)
+
+
+class LoggingSink:
+    """A sink writing each event to a logger.
+
+    :param logger: a logging.Logger or the name of a logger (default: 'multipagetiff.profiling')
+    """
+
+    def __init__(self, logger=None, level=_logging.INFO):
+        if logger is None or isinstance(logger, str):
+            logger = _logging.getLogger(logger or __name__)
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, event):
+        self.logger.log(self.level, "%r", event)
+
+
+# the default sink
+counters = Counters()
+
+
+def enabled():
+    return _config.profiling
+
+
+def emit(event):
+    """Send event to the sinks of config.profiling_sink"""
+    sinks = counters if _config.profiling_sink is None else _config.profiling_sink
+    if callable(sinks):
+        sinks = (sinks,)
+    for sink in sinks:
+        sink(event)
+
+
+class span:
+    """Context manager measuring the wall time of a block and emitting an Event.
+
+    The event is available in the block (to count pages, bytes and cache hits).
+    Nothing is measured nor emitted if profiling is disabled.
+
+        with span('normalize') as event:
+            ...
+            event.data(out)
+    """
+
+    __slots__ = ('event', '_start')
+
+    def __init__(self, name, **fields):
+        self.event = Event(name, **fields)
+
+    def __enter__(self):
+        self._start = _time.perf_counter() if _config.profiling else None
+        return self.event
+
+    def __exit__(self, *exc):
+        if self._start is not None:
+            self.event.seconds = _time.perf_counter() - self._start
+            emit(self.event)
+
+
+def iterate(name, iterable, count=True, **fields):
+    """Iterate over iterable, emitting one Event when it is exhausted (or closed).
+
+    Only the time spent producing the items is measured, not the time spent by the consumer.
+    If count is True the items are counted as pages (or, for 3D arrays, as blocks of pages).
+    """
+    if not _config.profiling:
+        yield from iterable
+        return
+    event = Event(name, **fields)
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = _time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                event.seconds += _time.perf_counter() - start
+            if count:
+                event.data(item, pages=None if getattr(item, 'ndim', 0) == 3 else 1, allocated=False)
+            yield item
+    finally:
+        emit(event)
@@ -1 +1,6 @@
 from .stack import Stack, log
+from .source import PageSource
+from .cache import PageCache, page_cache
+from .stats import StackStats
+from .pyramid import Pyramid
+from .lazy import LazyStack
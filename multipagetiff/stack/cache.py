@@ -0,0 +1,125 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+from collections import OrderedDict as _OrderedDict
+import threading as _threading
+from ..config import config as _config
+
+
+class PageCache:
+    """A cache of arrays bounded by their total size in bytes.
+
+    When the cache is full, entries are evicted according to the policy:
+    - 'lru': the least recently used entry is evicted first
+    - 'fifo': the oldest inserted entry is evicted first
+
+    If max_bytes or policy are None, the values of config.page_cache_size
+    and config.page_cache_policy are used (and can be changed at any time).
+    If max_entries is not None, the number of entries is also bounded.
+
+    The number of hits and misses is counted.
+    """
+
+    def __init__(self, max_bytes=None, policy=None, max_entries=None):
+        self._max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._policy = policy
+        self._entries = _OrderedDict()
+        self._lock = _threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def max_bytes(self):
+        return _config.page_cache_size if self._max_bytes is None else self._max_bytes
+
+    @property
+    def policy(self):
+        policy = _config.page_cache_policy if self._policy is None else self._policy
+        if policy not in ('lru', 'fifo'):
+            raise ValueError(f"Unknown cache policy {policy}. Use 'lru' or 'fifo'.")
+        return policy
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            if self.policy == 'lru':
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Store value in the cache. Values larger than the cache are not stored."""
+        size = getattr(value, 'nbytes', 0)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= getattr(self._entries.pop(key), 'nbytes', 0)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self.nbytes += size
+            self._evict()
+
+    def _evict(self):
+        while self._entries and (self.nbytes > self.max_bytes or
+                                 (self.max_entries is not None and len(self._entries) > self.max_entries)):
+            _, value = self._entries.popitem(last=False)
+            self.nbytes -= getattr(value, 'nbytes', 0)
+
+    def discard(self, predicate):
+        """Remove the entries whose key satisfies predicate(key)"""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self.nbytes -= getattr(self._entries.pop(key), 'nbytes', 0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return "PageCache({} entries, {:.1f}/{:.1f} MB, policy={}, hits={}, misses={})".format(
+            len(self), self.nbytes / 2**20, self.max_bytes / 2**20, self.policy, self.hits, self.misses)
+
+
+# the cache shared by the page sources that do not have their own
+page_cache = PageCache()
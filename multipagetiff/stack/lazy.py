@@ -0,0 +1,222 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+import threading as _threading
+import numpy as _np
+from ..parallel import ordered_map as _ordered_map
+from ..image_tools.image_tools import normalize as _normalize, percentiles as _percentiles
+
+
+class LazyStack:
+    """A lazy pipeline of operations on the pages of a stack.
+
+    The operations are recorded, not computed: crops and page limits restrict the pages
+    which are read, the other operations are fused and applied chunk by chunk when the
+    result is requested (compute, iter_chunks, project, to_stack), so that each page is
+    read once and only a few chunks are in memory.
+
+    e.g. stack.lazy().crop(10, 500, 10, 500).astype('float32').map_pages(f).project('max')
+
+    Each operation returns a new LazyStack.
+    """
+
+    def __init__(self, images, window, stages=(), stack=None):
+        """
+        :param images: the raw images (array, memmap or PageSource)
+        :param window: [start, end, r0, r1, c0, c1] the pages and region read from images
+        :param stages: the recorded operations, functions of a chunk of pages
+        :param stack: the Stack the pipeline comes from (for its properties)
+        """
+        self._images = images
+        self._window = list(window)
+        self._stages = list(stages)
+        self._stack = stack
+        self._page = None
+
+    def _derive(self, window=None, stage=None):
+        stages = self._stages + ([stage] if stage is not None else [])
+        return LazyStack(self._images, self._window if window is None else window, stages, self._stack)
+
+    def __repr__(self):
+        return "LazyStack({} pages, {} operations)".format(len(self), len(self._stages))
+
+    def __len__(self):
+        return self._window[1] - self._window[0]
+
+    @property
+    def _reshaped(self):
+        # True if an operation may have changed the shape of the pages
+        return any(kind == 'pages' for kind, _ in self._stages)
+
+    # --- operations ---
+
+    def crop(self, vertical_start, vertical_end, horizontal_start, horizontal_end):
+        """Crop the pages (indices relative to the current pages, end excluded)"""
+        if not self._reshaped:
+            start, end, r0, r1, c0, c1 = self._window
+            rows = range(r0, r1)[vertical_start:vertical_end]
+            cols = range(c0, c1)[horizontal_start:horizontal_end]
+            return self._derive(window=[start, end, rows.start, rows.stop, cols.start, cols.stop])
+        region = (slice(None), slice(vertical_start, vertical_end), slice(horizontal_start, horizontal_end))
+        return self._derive(stage=('elementwise', lambda block: block[region]))
+
+    def page_limits(self, start, end):
+        """Select the pages start to end (excluded) of the current pages"""
+        pages = range(self._window[0], self._window[1])[start:end]
+        return self._derive(window=[pages.start, pages.stop] + self._window[2:])
+
+    def astype(self, dtype):
+        """Cast the pages"""
+        return self._derive(stage=('elementwise', lambda block: block.astype(dtype, copy=False)))
+
+    def map(self, f, **kwargs):
+        """Apply f to each chunk of pages (a 3D array). f must return an array of the same shape."""
+        return self._derive(stage=('elementwise', lambda block: f(block, **kwargs)))
+
+    def map_pages(self, f, **kwargs):
+        """Apply f to each page (a 2D array). f must return arrays of the same shape for all pages."""
+        return self._derive(stage=('pages', lambda block: _np.stack([f(page, **kwargs) for page in block])))
+
+    def normalize(self, output_dtype='same', vmin=None, vmax=None, clip=None):
+        """Rescale the values between MIN and MAX (see image_tools.normalize).
+
+        If vmin and vmax are not given, they are computed on the current pages
+        (with an additional pass over the data when the result is computed).
+        The limits are computed once, by the first chunk: the chunks computed
+        in parallel by other threads wait for them.
+        """
+        prefix = self
+        limits = []
+        lock = _threading.Lock()
+
+        def get_limits():
+            with lock:
+                if not limits:
+                    if clip is not None:
+                        low, high = _percentiles(prefix, clip)
+                    else:
+                        low, high = prefix._range() if vmin is None or vmax is None else (vmin, vmax)
+                        low, high = (low if vmin is None else vmin), (high if vmax is None else vmax)
+                    limits.extend((low, high))
+                return limits
+
+        def stage(block):
+            low, high = get_limits()
+            return _normalize(block, output_dtype, vmin=low, vmax=high)
+        return self._derive(stage=('elementwise', stage))
+
+    # --- execution ---
+
+    def _read(self, a, b):
+        """The pages a to b (relative to the current pages) after all the operations"""
+        start, end, r0, r1, c0, c1 = self._window
+        block = _np.asarray(self._images[start + a:start + b, r0:r1, c0:c1])
+        for _, stage in self._stages:
+            block = stage(block)
+        return block
+
+    def _first_page(self):
+        if self._page is None:
+            self._page = self._read(0, 1)[0]
+        return self._page
+
+    @property
+    def shape(self):
+        return (len(self),) + self._first_page().shape
+
+    @property
+    def dtype(self):
+        return self._first_page().dtype
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            pages = range(len(self))[i]
+            if pages.step != 1:
+                return self._read(pages.start, pages.stop)[::pages.step] if len(pages) else \
+                    _np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            return self._read(pages.start, pages.stop)
+        i = range(len(self))[i]
+        return self._read(i, i + 1)[0]
+
+    def _range(self, chunk=16):
+        vmin, vmax = None, None
+        for block in self.iter_chunks(chunk):
+            vmin = block.min() if vmin is None else min(vmin, block.min())
+            vmax = block.max() if vmax is None else max(vmax, block.max())
+        return vmin, vmax
+
+    def iter_chunks(self, n=16, workers=None):
+        """Iterate over the computed pages in blocks of (at most) n pages.
+
+        :param workers: number of threads computing the blocks in parallel (default: 1)
+        """
+        # at most 2*workers blocks are in memory, they are yielded in order
+        starts = range(0, len(self), n)
+        yield from _ordered_map(lambda a: self._read(a, min(a + n, len(self))), starts, workers)
+
+    def compute(self, chunk=16, workers=None, out=None):
+        """Compute the pages.
+
+        :param out: preallocated output array (e.g. a numpy.memmap for results larger than memory)
+        :return: a numpy array
+        """
+        if out is None:
+            out = _np.empty(self.shape, dtype=self.dtype)
+        elif out.shape != self.shape:
+            raise ValueError(f"out has shape {out.shape}, expected {self.shape}")
+        z = 0
+        for block in self.iter_chunks(chunk, workers):
+            out[z:z + len(block)] = block
+            z += len(block)
+        return out
+
+    def project(self, ops='max', axes=0, chunk=16, workers=None):
+        """Compute projections of the pages (see stacktools.project), accumulated chunk by chunk.
+
+        :return: the projection if ops and axes are single values, otherwise a dict {(op, axis): array}
+        """
+        from ..stacktools.projection import Projector
+        single = isinstance(ops, str) and isinstance(axes, int)
+        ops = (ops,) if isinstance(ops, str) else ops
+        axes = (axes,) if isinstance(axes, int) else axes
+        projector = Projector(self.shape, [(op, axis) for axis in axes for op in ops])
+        z = 0
+        for block in self.iter_chunks(chunk, workers):
+            projector.combine(z, len(block), projector.partial(z, block))
+            z += len(block)
+        result = projector.result()
+        return result[ops[0], axes[0]] if single else result
+
+    def to_stack(self, chunk=16, workers=None):
+        """Compute the pages and return them in a new Stack (with the properties of the original stack)"""
+        stack = self._stack
+        imgs = self.compute(chunk, workers)
+        if stack is None:
+            from .stack import Stack
+            return Stack(imgs)
+        return stack.__class__(imgs, dx=stack.dx, dz=stack.dz, title=stack.title,
+                               z_label=stack.z_label, units=stack.units)
@@ -0,0 +1,108 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+import numpy as _np
+
+
+def bin_pages(pages, fz=1, fy=2, fx=2, chunk=16):
+    """Reduce the size of a stack of pages by averaging blocks of fz x fy x fx pixels.
+
+    The last pages, rows and columns which do not fill a block are dropped.
+    The pages are read chunk by chunk (pages can be a lazy array of pages).
+    Integer data are rounded to the original type.
+
+    :return: a numpy array of shape (nz//fz, ny//fy, nx//fx)
+    """
+    nz, ny, nx = (n // f for n, f in zip(pages.shape, (fz, fy, fx)))
+    dtype = _np.dtype(pages.dtype)
+    work_dtype = _np.float64 if dtype.itemsize > 4 else _np.float32
+    out = _np.empty((nz, ny, nx), dtype=dtype)
+    step = max(chunk // fz, 1) * fz
+    for i in range(0, nz * fz, step):
+        block = _np.asarray(pages[i:min(i + step, nz * fz), :ny * fy, :nx * fx])
+        block = block.reshape(len(block) // fz, fz, ny, fy, nx, fx).mean(axis=(1, 3, 5), dtype=work_dtype)
+        if dtype.kind in 'uib':
+            _np.rint(block, out=block)
+        out[i // fz:(i + len(block) * fz) // fz] = block
+    return out
+
+
+class Pyramid:
+    """Multi-resolution versions of a stack of pages.
+
+    Level k is binned by 2**k along the rows and columns of the pages (and along z if z is True).
+    The levels are computed on demand, each from the previous one, and kept in memory.
+    Level 0 is the original array.
+    """
+
+    def __init__(self, pages, levels=4, z=False):
+        self.z = z
+        self.shape = tuple(pages.shape)
+        # each level must have at least one pixel along each binned axis
+        binned = self.shape if z else self.shape[1:]
+        self.levels = max(0, min(levels, int(_np.log2(max(min(binned), 1)))))
+        self._levels = [pages]
+
+    def __repr__(self):
+        return "Pyramid({} levels of {}, z={})".format(self.levels, self.shape, self.z)
+
+    def factors(self, k):
+        """The binning factors (z, rows, columns) of level k"""
+        f = 2**k
+        return (f if self.z else 1, f, f)
+
+    def level(self, k):
+        """The pages of level k"""
+        if not 0 <= k <= self.levels:
+            raise IndexError(f"Level {k} is not between 0 and {self.levels}")
+        while len(self._levels) <= k:
+            self._levels.append(bin_pages(self._levels[-1], 2 if self.z else 1, 2, 2))
+        return self._levels[k]
+
+    def page(self, i, k):
+        """Page i (at full resolution) of level k.
+
+        If level k is not computed yet and the pyramid is not binned along z,
+        only the page i is binned.
+        """
+        if k < len(self._levels):
+            return self._levels[k][i // self.factors(k)[0]]
+        if self.z:
+            return self.level(k)[i // self.factors(k)[0]]
+        page = self._levels[0][i:i+1]
+        for _ in range(k):
+            page = bin_pages(page, 1, 2, 2)
+        return page[0]
+
+    def select(self, scale):
+        """The coarsest level with at least one pixel per displayed pixel.
+
+        :param scale: the number of displayed pixels per pixel of level 0
+        """
+        if scale <= 0:
+            return self.levels
+        return int(min(self.levels, max(0, _np.floor(_np.log2(1 / scale)))))
@@ -0,0 +1,195 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+import itertools as _itertools
+import numpy as _np
+from ..profiling import span as _span
+
+_keys = _itertools.count()
+
+
+def _slice_length(n, sl):
+    return len(range(n)[sl])
+
+
+class PageSource:
+    """Base class of the page sources that are not numpy arrays.
+
+    A Stack can hold its raw images as a numpy array (in memory or memory mapped)
+    or as a PageSource, which produces its pages on demand (e.g. decoding them from a file).
+
+    A PageSource behaves like a read-only 3D array:
+    - slicing it (source[a:b, r0:r1, c0:c1]) returns a lazy view, no page is read
+    - indexing a page (source[i]) reads only that page
+    - numpy.asarray(source) reads all the pages.
+
+    Subclasses must set shape and dtype and implement _read_page(i).
+    If a cache (see PageCache) is given, the pages read are kept in it.
+    """
+
+    def __init__(self, shape, dtype, cache=None):
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = _np.dtype(dtype)
+        self.cache = cache
+        self._key = next(_keys)
+
+    def _read_page(self, i):
+        """Return the i-th page as a numpy array"""
+        raise NotImplementedError
+
+    def page(self, i):
+        """Return the i-th page (read-only)"""
+        if self.cache is None:
+            return self._read_page(i)
+        key = (self._key, i)
+        with _span('source.page', pages=1, cache='hit') as event:
+            page = self.cache.get(key)
+            if page is None:
+                event.cache = 'miss'
+                page = self._read_page(i)
+                # cached pages are shared: they must not be modified
+                page.flags.writeable = False
+                self.cache.put(key, page)
+                event.allocated = page.nbytes
+            event.nbytes = page.nbytes
+        return page
+
+    def read(self, pages=None, index=(), dtype=None):
+        """Read the given pages (all by default) into a new array.
+
+        :param pages: iterable of page indices
+        :param index: index applied to each page
+        :param dtype: type of the output array
+        """
+        pages = range(len(self)) if pages is None else pages
+        out = None
+        for k, i in enumerate(pages):
+            page = self.page(i)[index]
+            if out is None:
+                out = _np.empty((len(pages), *page.shape), dtype=self.dtype if dtype is None else dtype)
+            out[k] = page
+        if out is None:
+            out = _np.empty((0, *self.shape[1:]), dtype=self.dtype if dtype is None else dtype)[(slice(None), *index)]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i+1:]
+
+        first, rest = key[0], key[1:]
+        all_pages = range(len(self))
+
+        if isinstance(first, (int, _np.integer)):
+            return self.page(all_pages[first])[rest]
+
+        if isinstance(first, slice):
+            if all(isinstance(k, slice) for k in rest):
+                return SourceView(self, all_pages[first], rest)
+            return self.read(all_pages[first], rest)
+
+        pages = _np.arange(len(self))[first]
+        if pages.ndim == 1 and not any(isinstance(k, (list, _np.ndarray)) for k in rest):
+            return self.read(pages, rest)
+
+        # advanced indexing across several axes
+        return _np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.read(dtype=dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.page(i)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(_np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def astype(self, dtype, copy=True):
+        return self.read(dtype=dtype)
+
+    def copy(self):
+        return self.read()
+
+    def _reduce(self, ufunc, axis=None, **kwargs):
+        if axis not in (None, 0) or kwargs:
+            return getattr(_np.asarray(self), ufunc.__name__[:3])(axis=axis, **kwargs)
+        # stream through the pages
+        acc = None
+        for page in self:
+            r = page if axis == 0 else ufunc.reduce(page, axis=None)
+            acc = _np.array(r) if acc is None else ufunc(acc, r, out=acc if axis == 0 else None)
+        return acc
+
+    def max(self, axis=None, **kwargs):
+        return self._reduce(_np.maximum, axis, **kwargs)
+
+    def min(self, axis=None, **kwargs):
+        return self._reduce(_np.minimum, axis, **kwargs)
+
+    def sum(self, *args, **kwargs):
+        return _np.asarray(self).sum(*args, **kwargs)
+
+    def mean(self, *args, **kwargs):
+        return _np.asarray(self).mean(*args, **kwargs)
+
+    def std(self, *args, **kwargs):
+        return _np.asarray(self).std(*args, **kwargs)
+
+    def __repr__(self):
+        return "{}(shape={}, dtype={})".format(type(self).__name__, self.shape, self.dtype)
+
+
+class SourceView(PageSource):
+    """A lazy view on a selection of pages and a region of a PageSource"""
+
+    def __init__(self, parent, pages, index):
+        shape = [len(pages)]
+        for n, sl in zip(parent.shape[1:], index):
+            shape.append(_slice_length(n, sl))
+        shape.extend(parent.shape[1+len(index):])
+        super().__init__(shape, parent.dtype)
+        self.parent = parent
+        self.pages = pages
+        self.index = index
+
+    def _read_page(self, i):
+        return self.parent.page(self.pages[i])[self.index]
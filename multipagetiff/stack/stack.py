@@ -26,13 +26,27 @@ along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from collections.abc import Sequence
+import functools as _ft
 import numpy as _np
 import logging
+from .source import PageSource as _PageSource
+from .stats import StatsCache as _StatsCache
+from .cache import PageCache as _PageCache
+from .pyramid import Pyramid as _Pyramid, bin_pages as _bin_pages
+from .lazy import LazyStack as _LazyStack
+from ..config import config as _config
+from ..profiling import span as _span
+from ..parallel import ordered_map as _ordered_map
+from ..image_tools.image_tools import normalize as _normalize
 
-logging.basicConfig(level=logging.WARNING)
 log = logging.getLogger(__name__)
 
 
+def _apply_to_block(f, block, copy, kwargs):
+    """Apply f to each page of block (in a worker)"""
+    return [f(page.copy() if copy else page, **kwargs) for page in block]
+
+
 class Stack(Sequence):
     """The multipage tiff object.
     it behaves as a list which members are the pages of the tiff.
@@ -41,7 +55,8 @@ class Stack(Sequence):
 
     def __init__(self, imgs, dx=1, dz=1, title='', z_label='depth', units='units'):
         """
-        :param imgs: numpy array of shape (Nz, Nx, Ny) containing the raw images of the stack
+        :param imgs: numpy array of shape (Nz, Nx, Ny) containing the raw images of the stack.
+            It can be a numpy.memmap or a PageSource which reads the pages on demand.
         :param dx: value of one pixel in physical units, on the transverse plane (X,Y)
         :param dz: value of one pixel in physical units, on the axial direction (Z)
         :param units: physical units of the z axis
@@ -65,19 +80,36 @@ class Stack(Sequence):
         # by setting this flag to TRUE the pages will be recalculated at next access
         self._update_pages = True
         self._normalize = False
+        self._normalize_clip = None
         self._dtype_out = "same"
 
     def reverse(self):
         self._imgs = self.pages[::-1]
+        self._reset_caches()
         self.start_page = len(self) - self.end_page
         self.end_page = len(self) - self.start_page
 
-    def reduce(self, f=2):
-        self._imgs = self.pages[::f]
-        self.dz *= 2
-        self.keypage = round(self.keypage//f)
-        self.start_page = round(self.start_page//f)
-        self.end_page = round(self.end_page//f)
+    def reduce(self, f=2, method='subsample'):
+        """Reduce the number of pages by a factor f. The selected pages become the raw images.
+
+        :param method: 'subsample' keeps one page every f,
+            'mean' averages groups of f pages (which avoids aliasing, the last pages
+            which do not fill a group are dropped).
+        """
+        if method == 'subsample':
+            imgs = self.pages[::f]
+        elif method == 'mean':
+            imgs = _bin_pages(self.pages, f, 1, 1)
+        else:
+            raise ValueError(f"Unknown method {method}. Use 'subsample' or 'mean'.")
+        keypage = (self.keypage - self.start_page) // f
+        share = self._share
+        self._set_raw_images(imgs)
+        if method == 'subsample' and not self.normalize and str(self._dtype_out) == "same":
+            # the new raw images are a view of the (possibly shared) previous ones
+            self._share = share
+        self.keypage = keypage
+        self.dz *= f
 
     def copy_props_from_stack(self, stack):
         self.dx = stack.dx
@@ -87,11 +119,49 @@ class Stack(Sequence):
         self.z_label = stack.z_label
         self._crop = stack._crop.copy()
         self._normalize = stack._normalize
+        self._normalize_clip = stack._normalize_clip
         self._dtype_out = stack._dtype_out
 
     def __getitem__(self, i):
         return self.pages[i]
 
+    def __setitem__(self, i, value):
+        """Write into the selected pages (stack[i] = page, stack[i, r, c] = value, ...).
+
+        If the raw images are shared with other stacks (see copy), they are copied first.
+        If they are read on demand (a PageSource, e.g. read_stack(lazy=True)), they are loaded in memory first.
+        """
+        self._own()
+        pages = self.pages
+        if isinstance(pages, _np.ndarray) and not pages.flags.writeable and not self.shares_data:
+            # a read-only view made while the raw images were shared
+            self._update_pages = True
+            pages = self.pages
+        pages[i] = value
+        self.invalidate_stats()
+        self._pyramids.clear()
+
+    @property
+    def shares_data(self):
+        """True if the raw images are shared with other stacks (copies of this one).
+
+        The pages of a stack sharing its raw images are read-only:
+        write them through stack[i] = ..., which copies the raw images first.
+        """
+        return self._share[0] > 1
+
+    def _own(self):
+        """Copy the raw images if they are shared with other stacks (copy on write)
+        or if they are read on demand (a PageSource)"""
+        if not self.shares_data and not isinstance(self._imgs, _PageSource):
+            return
+        log.info("copying raw images")
+        self._share[0] -= 1
+        self._share = [1]
+        self._imgs = _np.array(self._imgs)
+        # the statistics and derived pages were shared too
+        self._reset_caches()
+
     def __len__(self):
         return self._crop[1] - self._crop[0]
 
@@ -102,38 +172,166 @@ class Stack(Sequence):
         self.end_page = self.keypage + round(end//self.dz)
 
     def _set_raw_images(self, images):
-        if type(images) != _np.ndarray:
+        if not isinstance(images, (_np.ndarray, _PageSource)):
             try:
-                images = _np.ndarray(images)
+                images = _np.asarray(images)
             except:
                 raise ValueError(
                     "The images parameter is not a numpy array or is not convertible into one.")
         self._imgs = images
-        self._crop = [0, len(images), 0, images[0].shape[0],
-                      0, images[0].shape[1]]
-        self._lazy_pages = None
+        # number of stacks sharing the raw images
+        self._share = [1]
+        self._reset_caches()
+        self._crop = [0, len(images), 0, images.shape[1],
+                      0, images.shape[2]]
         self.keypage = len(self)//2
+
+    def _reset_caches(self):
+        """Forget everything computed from the raw images"""
+        self._stats = _StatsCache()
+        self._pages_cache = _PageCache(max_bytes=_config.derived_pages_cache_size,
+                                       max_entries=_config.derived_pages_cache_entries)
+        self._pyramids = _PageCache(max_entries=4)
+        self._lazy_pages = None
         self._update_pages = True
 
+    @property
+    def pages_cache(self):
+        """The cache of the normalized or cast selections of this stack (a PageCache).
+
+        It keeps the last computed selections, keyed by (crop, page limits, dtype_out, normalization),
+        so that switching between them does not compute them again.
+        Its size is bounded by config.derived_pages_cache_size and config.derived_pages_cache_entries
+        (as they are when the raw images are set).
+        Its hits and misses attributes count the accesses.
+        Plain crops are views of the raw images and are not cached.
+        revert_pages() clears it.
+        """
+        return self._pages_cache
+
+    def build_pyramid(self, levels=4, z=False, raw=False):
+        """Return a multi-resolution Pyramid of the selected pages.
+
+        Level k is binned (averaged) by 2**k along the rows and columns (and along z if z is True).
+        The levels are computed on demand and the pyramid is cached for the current selection,
+        so that previews and plots do not need to process the full resolution data.
+
+        :param raw: make the pyramid of the raw images (uncropped, not normalized) instead of the selection
+        """
+        if raw:
+            key = ('raw', levels, z)
+        else:
+            key = (tuple(self._crop), str(self._dtype_out), self.normalize,
+                   self._normalize_clip if self.normalize else None, levels, z)
+        pyramid = self._pyramids.get(key)
+        if pyramid is None:
+            pyramid = _Pyramid(self._imgs if raw else self.pages, levels=levels, z=z)
+            self._pyramids.put(key, pyramid)
+        return pyramid
+
     def copy(self):
-        """Copy this stack into a new Stack instance"""
+        """Copy this stack into a new Stack instance
+
+        The raw images are not copied: they are shared until one of the stacks writes
+        its pages (copy on write)."""
         new_stack = Stack(self._imgs, dx=self.dx, dz=self.dz,
                           title=self.title, z_label=self.z_label, units=self.units)
 
         new_stack.copy_props_from_stack(self)
+        # the raw images are the same: so are their statistics
+        new_stack._stats = self._stats
+        self._share[0] += 1
+        new_stack._share = self._share
+        # the pages of this stack may be a writable view of the raw images
+        self._update_pages = True
+        self._lazy_pages = None
 
         return new_stack
 
-    def apply_to_pages(self, f, **kwargs):
+    def apply_to_pages(self, f, workers=None, executor='thread', out=None, as_array=False, chunk=16,
+                       copy=False, **kwargs):
         """Apply function f with the given kwargs to each page of a stack.
         f is a function that accepts 2D arrays as input.
 
-        Return the results as a list."""
-        pages = self.pages.copy()
-        result = list()
-        for page in pages:
-            result.append(f(page, **kwargs))
-        return result
+        The pages are read chunk by chunk (chunk pages at a time) and, if workers > 1,
+        the chunks are processed in parallel by a pool of threads or processes.
+
+        :param workers: number of threads or processes (default: 1, no pool)
+        :param executor: 'thread' or 'process' (f and its results must be picklable)
+        :param out: preallocated array for the results, of shape (len(stack), ...)
+        :param as_array: return the results in a new array (f must return arrays
+            of the same shape and type) instead of a list
+        :param copy: pass a copy of each page to f (if f modifies its input)
+
+        Return the results as a list (or as an array if out is given or as_array is True)."""
+        results = [] if out is None and not as_array else None
+        z = 0
+
+        def store(values):
+            nonlocal out, z
+            if results is not None:
+                results.extend(values)
+                return
+            for value in values:
+                value = _np.asarray(value)
+                if out is None:
+                    out = _np.empty((len(self),) + value.shape, dtype=value.dtype)
+                elif out.shape[1:] != value.shape:
+                    raise ValueError(f"f returned an array of shape {value.shape}, expected {out.shape[1:]}")
+                out[z] = value
+                z += 1
+
+        # the results are stored in order, at most 2*workers chunks are pending
+        task = _ft.partial(_apply_to_block, f, copy=copy, kwargs=kwargs)
+        for values in _ordered_map(task, self.iter_chunks(chunk), workers, executor):
+            store(values)
+
+        return results if results is not None else out
+
+    def iter_chunks(self, n=64):
+        """Iterate over the selected pages of the stack in blocks of (at most) n pages.
+
+        If the pages are not already in memory, each block is sliced from the raw images
+        (and cast to dtype_out), so that only one block at a time is materialized.
+        """
+        if n < 1:
+            raise ValueError("n must be a positive integer.")
+
+        if self.normalize or not (self._update_pages or self._lazy_pages is None):
+            # the pages are (or must be) computed as a whole
+            pages = self.pages
+            for i in range(0, len(pages), n):
+                yield pages[i:i+n]
+            return
+
+        start, end, r0, r1, c0, c1 = self._crop
+        for i in range(start, end, n):
+            chunk = _np.asarray(self._imgs[i:min(i+n, end), r0:r1, c0:c1])
+            if str(self._dtype_out) != "same":
+                chunk = chunk.astype(self._dtype_out)
+            elif self.shares_data:
+                # read-only, so that the other stacks are not modified
+                chunk = chunk.view()
+                chunk.flags.writeable = False
+            yield chunk
+
+    def lazy(self):
+        """Return a lazy pipeline of operations on the selected pages (a LazyStack).
+
+        e.g. stack.lazy().crop(0, 100, 0, 100).astype('float32').map_pages(f).project('max')
+        The operations are computed chunk by chunk, reading each page once.
+        """
+        pipeline = _LazyStack(self._imgs, self._crop, stack=self)
+        if self.normalize:
+            output_dtype = self._dtype_out
+            vmin = vmax = None
+            if self._normalize_clip is None:
+                stats = self._selection_stats(cast=False)
+                vmin, vmax = stats.min, stats.max
+            return pipeline.normalize(output_dtype, vmin=vmin, vmax=vmax, clip=self._normalize_clip)
+        if str(self._dtype_out) != "same":
+            return pipeline.astype(self._dtype_out)
+        return pipeline
 
     def apply(self, f, **kwargs):
         """Apply a function to the pages of the stack as a 3D array.
@@ -177,7 +375,7 @@ class Stack(Sequence):
 
     def reset_selection(self):
         """reset the pages crop"""
-        h, w = self._imgs[0].shape
+        h, w = self._imgs.shape[1:3]
         self._crop[2:] = [0, h, 0, w]
 
     def reset_page_limits(self):
@@ -191,10 +389,16 @@ class Stack(Sequence):
         self._lazy_pages = None
 
     def overwrite_raw_images(self):
+        share = self._share
+        plain = not self.normalize and str(self._dtype_out) == "same"
         self._set_raw_images(self.pages)
+        if plain:
+            # the new raw images are a view of the (possibly shared) previous ones
+            self._share = share
 
     def revert_pages(self):
         """Revert the pages to undo direct modifications"""
+        self._pages_cache.clear()
         self._update_pages = True
 
     def _apply_normalization(self):
@@ -209,26 +413,22 @@ class Stack(Sequence):
         MIN and MAX are the limits of the data-type of this stack
 
         NOTE: The normalization is calculated and applied on the selected pages (cropped)
-        """
 
-        output_dtype = self._imgs.dtype if self._dtype_out == 'same' else self._dtype_out
+        if the clip percentiles are set (see set_normalization), the values outside are saturated.
 
-        try:
-            min_level = _np.iinfo(output_dtype).min
-            max_level = _np.iinfo(output_dtype).max
-        except ValueError:
-            # the output type is not an integer type
-            min_level = 0
-            max_level = 1
+        The data is normalized chunk by chunk, directly in an array of the output type.
+        """
 
-        imgs = self.pages.astype(_np.float64)
+        output_dtype = self._imgs.dtype if str(self._dtype_out) == 'same' else self._dtype_out
 
-        imgs -= self.pages.min()
-        imgs /= self.pages.max() - self.pages.min()
-        imgs *= max_level + min_level
-        imgs -= min_level
+        stats = self._selection_stats(cast=False, histogram=self._normalize_clip is not None)
+        if self._normalize_clip is None:
+            vmin, vmax = stats.min, stats.max
+        else:
+            vmin, vmax = stats.percentile(self._normalize_clip)
 
-        self._lazy_pages = imgs.astype(output_dtype)
+        start, end, r0, r1, c0, c1 = self._crop
+        self._lazy_pages = _normalize(self._imgs[start:end, r0:r1, c0:c1], output_dtype, vmin=vmin, vmax=vmax)
 
     @ property
     def normalize(self):
@@ -255,13 +455,16 @@ class Stack(Sequence):
         t : a numpy datatype specifier or 'same' (which indicates the same as the initial stack).
         """
 
+        if str(t) == 'same':
+            self.dtype_out = t
+            return
         try:
             _np.zeros(2, dtype=t)
             self.dtype_out = t
         except:
             raise TypeError(f"{t} is not a valid type.")
 
-    def set_normalization(self, on=True):
+    def set_normalization(self, on=True, clip=None):
         """If true, the stack will be normalized.
 
         Pixel values will be rescaled between MIN and MAX.
@@ -274,8 +477,12 @@ class Stack(Sequence):
             MIN and MAX are the limits of the data-type of this stack
 
         NOTE: The normalization is calculated and applied on the selected pages (cropped)
+
+        :param clip: (low, high) percentiles of the pixel values mapped to MIN and MAX,
+            the values outside are saturated. None to use the min and max of the pages.
         """
-        self.normalize = True
+        self._normalize_clip = None if clip is None else tuple(clip)
+        self.normalize = on
 
     @ property
     def pages(self):
@@ -284,20 +491,44 @@ class Stack(Sequence):
         if self._update_pages or (self._lazy_pages is None):
             log.debug("accessing pages")
             self._update_pages = False
+            with _span('stack.pages') as event:
+                self._compute_pages(event)
+                event.data(self._lazy_pages, allocated=event.cache == 'miss')
 
-            start, end, r0, r1, c0, c1 = self._crop
-            self._lazy_pages = self._imgs[start:end, r0:r1, c0:c1]
+        return self._lazy_pages
 
+    def _compute_pages(self, event):
+        """Set the pages of the selection (a view, or a cached or new array)"""
+        start, end, r0, r1, c0, c1 = self._crop
+        if not self.normalize and str(self._dtype_out) == "same":
+            # a plain crop: a view of the raw images
+            pages = self._imgs[start:end, r0:r1, c0:c1]
+            if self.shares_data and isinstance(pages, _np.ndarray):
+                # read-only, so that the other stacks are not modified
+                pages = pages.view()
+                pages.flags.writeable = False
+            self._lazy_pages = pages
+            return
+
+        key = (tuple(self._crop), str(self._dtype_out), self.normalize,
+               self._normalize_clip if self.normalize else None)
+        pages = self._pages_cache.get(key)
+        if pages is None:
+            event.cache = 'miss'
             if self.normalize:
                 # normalization also changes the data type
                 log.info("normalizing stack")
                 self._apply_normalization()
-            elif str(self._dtype_out) != "same":
+            else:
                 log.info(f"casting stack to type {self._dtype_out}")
                 # only change data type
-                self._lazy_pages = self._lazy_pages.astype(self._dtype_out)
-
-        return self._lazy_pages
+                self._lazy_pages = _np.asarray(self._imgs[start:end, r0:r1, c0:c1]).astype(self._dtype_out)
+            self._pages_cache.put(key, self._lazy_pages)
+            if key not in self._pages_cache:
+                log.info("the selection is larger than config.derived_pages_cache_size: it is not cached")
+        else:
+            event.cache = 'hit'
+            self._lazy_pages = pages
 
     @property
     def shape(self):
@@ -403,18 +634,58 @@ class Stack(Sequence):
     def raw_images(self, images):
         self._set_raw_images(images)
 
+    def stats(self, histogram=False, bins=256):
+        """Return the statistics of the selected pages (a StackStats).
+
+        min, max, mean, std (and optionally the histogram) are computed in one pass
+        over the data and cached: they are not computed again for the same crop region,
+        page limits and data type. The per-page statistics of a crop region are reused
+        when the page limits change.
+        If the raw images are modified in place, call invalidate_stats().
+
+        :param histogram: also compute the histogram of the values.
+            For 8 and 16 bits integer data it has one bin per value, otherwise bins bins
+            between the min and max of the selection.
+        """
+        return self._selection_stats(cast=True, histogram=histogram, bins=bins)
+
+    def invalidate_stats(self):
+        """Forget the cached statistics (e.g. after modifying the raw images in place)"""
+        self._stats.clear()
+
+    def _selection_stats(self, cast=True, histogram=False, bins=256):
+        """Statistics of the selected pages, cast to dtype_out (if cast) and normalized (if normalize)"""
+        start, end, r0, r1, c0, c1 = self._crop
+
+        if cast and self.normalize:
+            # normalized values depend on the whole selection: use the computed pages
+            pages = self.pages
+            key = ('normalized', str(self._dtype_out), self._normalize_clip, tuple(self._crop))
+            return self._stats.stats(lambda a, b: _np.asarray(pages[a:b]), len(pages), pages.dtype,
+                                     key, 0, len(pages), histogram, bins)
+
+        dtype = self._imgs.dtype
+        if cast and str(self._dtype_out) != "same":
+            dtype = _np.dtype(self._dtype_out)
+
+        def read(a, b):
+            return _np.asarray(self._imgs[a:b, r0:r1, c0:c1]).astype(dtype, copy=False)
+
+        key = (r0, r1, c0, c1, dtype.str)
+        return self._stats.stats(read, len(self._imgs), dtype, key, start, end, histogram, bins)
+
     @ property
     def max(self):
-        return self.pages.max()
+        return self.stats().max
 
     @ property
     def mean(self):
-        return self.pages.mean()
+        return self.stats().mean
 
     @ property
     def min(self):
-        return self.pages.min()
+        return self.stats().min
 
     @ property
     def std(self):
-        return self.pages.std()
+        return self.stats().std
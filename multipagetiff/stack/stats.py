@@ -0,0 +1,189 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+from collections import OrderedDict as _OrderedDict
+import numpy as _np
+from ..image_tools.image_tools import exact_histogram_range, histogram_percentile as _histogram_percentile
+
+
+class StackStats:
+    """Statistics of a set of pages.
+
+    count, min, max, sum, mean, var, std: the statistics of all the pixel values.
+    histogram, bin_edges: the histogram of the values (if computed).
+        For 8 and 16 bits integer data the histogram has one bin per possible value.
+    """
+
+    def __init__(self, count, min, max, mean, m2, histogram=None, bin_edges=None):
+        self.count = count
+        self.min = min
+        self.max = max
+        self.mean = mean
+        self._m2 = m2
+        self.histogram = histogram
+        self.bin_edges = bin_edges
+
+    @property
+    def sum(self):
+        return self.mean * self.count
+
+    @property
+    def var(self):
+        return self._m2 / self.count
+
+    @property
+    def std(self):
+        return _np.sqrt(self.var)
+
+    def percentile(self, q):
+        """Estimate the q-th percentile(s) of the values from the histogram.
+
+        The estimate is exact for 8 and 16 bits integer data.
+        """
+        if self.histogram is None:
+            raise ValueError("The histogram has not been computed.")
+        return _histogram_percentile(self.histogram, self.bin_edges, q)
+
+    def __repr__(self):
+        return "StackStats(count={}, min={}, max={}, mean={:.6g}, std={:.6g})".format(
+            self.count, self.min, self.max, self.mean, self.std)
+
+
+class PageStats:
+    """Per-page statistics (min, max, count, mean, M2) of a stack region, filled on demand."""
+
+    def __init__(self, n_pages, dtype):
+        self.computed = _np.zeros(n_pages, dtype=bool)
+        self.min = _np.zeros(n_pages, dtype=dtype)
+        self.max = _np.zeros(n_pages, dtype=dtype)
+        self.count = _np.zeros(n_pages, dtype=_np.int64)
+        self.mean = _np.zeros(n_pages, dtype=_np.float64)
+        self.m2 = _np.zeros(n_pages, dtype=_np.float64)
+
+    def update(self, i, block):
+        """Compute the statistics of the pages i, i+1, ... of block"""
+        j = i + len(block)
+        axes = tuple(range(1, block.ndim))
+        n = int(_np.prod(block.shape[1:]))
+        mean = block.sum(axis=axes, dtype=_np.float64) / n
+        dev = block - mean.reshape(-1, *[1] * len(axes))
+        self.min[i:j] = block.min(axis=axes)
+        self.max[i:j] = block.max(axis=axes)
+        self.count[i:j] = n
+        self.mean[i:j] = mean
+        dev = dev.reshape(len(dev), -1)
+        self.m2[i:j] = _np.einsum('ij,ij->i', dev, dev)
+        self.computed[i:j] = True
+
+    def missing(self, start, end):
+        """The runs [a, b) of pages between start and end whose statistics are not computed"""
+        idx = _np.flatnonzero(~self.computed[start:end]) + start
+        if len(idx) == 0:
+            return []
+        breaks = _np.flatnonzero(_np.diff(idx) != 1)
+        starts = _np.concatenate([idx[:1], idx[breaks + 1]])
+        ends = _np.concatenate([idx[breaks], idx[-1:]]) + 1
+        return list(zip(starts.tolist(), ends.tolist()))
+
+    def combine(self, start, end):
+        """Return the StackStats of the pages start to end (excluded)"""
+        count = self.count[start:end]
+        mean = self.mean[start:end]
+        total = int(count.sum())
+        grand_mean = float((count * mean).sum() / total)
+        m2 = float((self.m2[start:end] + count * (mean - grand_mean)**2).sum())
+        return StackStats(total, self.min[start:end].min(), self.max[start:end].max(), grand_mean, m2)
+
+
+class StatsCache:
+    """Statistics of the selections of a stack, cached by (region, data type).
+
+    Per-page statistics are kept for each region, so changing the page limits does not
+    require to read the data again; histograms are kept per selection.
+    The number of regions kept is bounded.
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._pages = _OrderedDict()
+        self._histograms = _OrderedDict()
+
+    def _get(self, entries, key, factory):
+        if key in entries:
+            entries.move_to_end(key)
+            return entries[key]
+        value = entries[key] = factory()
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+        return value
+
+    def stats(self, read, n_pages, dtype, key, start, end, histogram=False, bins=256, chunk=16):
+        """Return the StackStats of the pages start to end of a region.
+
+        :param read: function read(a, b) returning the pages a to b of the region as an array
+        :param n_pages: the total number of pages of the region
+        :param key: a hashable identifying the region and the data type
+        """
+        page_stats = self._get(self._pages, key, lambda: PageStats(n_pages, dtype))
+
+        exact = exact_histogram_range(dtype) if histogram else None
+        hist_key = (key, start, end, bins if exact is None else None)
+        need_histogram = histogram and hist_key not in self._histograms
+        counts = None
+        if exact is not None and need_histogram:
+            counts = _np.zeros(exact[1] - exact[0] + 1, dtype=_np.int64)
+
+        # single pass over the pages that are missing (or over all pages, for an exact histogram)
+        runs = [(start, end)] if counts is not None else page_stats.missing(start, end)
+        for a, b in runs:
+            for i in range(a, b, chunk):
+                block = read(i, min(i + chunk, b))
+                if not page_stats.computed[i:i+len(block)].all():
+                    page_stats.update(i, block)
+                if counts is not None:
+                    counts += _np.bincount((block.ravel().astype(_np.int64) - exact[0]), minlength=len(counts))
+
+        result = page_stats.combine(start, end)
+
+        if histogram:
+            if need_histogram:
+                if counts is not None:
+                    edges = _np.arange(exact[0], exact[1] + 2)
+                else:
+                    # second pass, with the bins limited by the min and max of the selection
+                    edges = _np.histogram_bin_edges([], bins=bins, range=(float(result.min), float(result.max)))
+                    counts = _np.zeros(len(edges) - 1, dtype=_np.int64)
+                    for i in range(start, end, chunk):
+                        counts += _np.histogram(read(i, min(i + chunk, end)), bins=edges)[0]
+                self._get(self._histograms, hist_key, lambda: (counts, edges))
+            result.histogram, result.bin_edges = self._get(self._histograms, hist_key, None)
+
+        return result
+
+    def clear(self):
+        self._pages.clear()
+        self._histograms.clear()
@@ -1 +1,2 @@
-from .stacktools import _get_orthogonal_slices, empty_like, unpad_stack, affine_transform
+from .stacktools import _get_orthogonal_slices, empty_like, unpad_stack, estimate_stack_padding, affine_transform, resample_isotropic
+from .projection import project, sliding_project, Projector
@@ -0,0 +1,311 @@
+"""
+
+MULTIPAGETIFF
+
+tools for multipage tiff images manipulation
+
+author: Marco Pascucci
+copyright: 2018
+
+
+This file is part of MULTIPAGETIFF.
+
+MULTIPAGETIFF is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+MULTIPAGETIFF is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+
+from collections import deque as _deque
+import numpy as _np
+from ..profiling import span as _span, iterate as _iterate
+from ..parallel import ordered_map as _ordered_map
+
+OPS = ('max', 'min', 'sum', 'mean', 'std', 'argmax', 'argmin')
+
+
+def _sum_dtype(dtype):
+    if dtype.kind == 'u':
+        return _np.uint64
+    if dtype.kind in 'ib':
+        return _np.int64
+    return _np.float64
+
+
+class Projector:
+    """Computes projections (max, min, sum, mean, std, argmax, argmin) of a 3D array
+    along its axes, from chunks of consecutive pages (along axis 0).
+
+    The projections along axis 0 are accumulated chunk after chunk, the projections
+    along the axes 1 and 2 are computed for each chunk.
+    partial() can run in parallel on different chunks; combine() must be called
+    with the partial results in the order of the chunks.
+    """
+
+    def __init__(self, shape, pairs, last=()):
+        """
+        :param shape: the shape of the 3D array
+        :param pairs: the projections to compute, as a list of (op, axis)
+        :param last: the axes along which argmax and argmin return the last occurrence
+            of the extremum (the first one by default)
+        """
+        self.shape = tuple(shape)
+        self.last = frozenset(last)
+        self.pairs = list(dict.fromkeys(tuple(p) for p in pairs))
+        for op, axis in self.pairs:
+            if op not in OPS:
+                raise ValueError(f"Unknown projection {op}. Use one of {OPS}.")
+            if axis not in (0, 1, 2):
+                raise ValueError(f"Invalid axis {axis}")
+        self._results = {}
+        self._z_ops = {op for op, axis in self.pairs if axis == 0}
+        self._count = 0
+
+    def _out(self, key, shape, dtype):
+        if key not in self._results:
+            self._results[key] = _np.empty(shape, dtype=dtype)
+        return self._results[key]
+
+    def _arg(self, block, op, axis):
+        """argmax or argmin of block along axis (first or last occurrence)"""
+        if axis not in self.last:
+            return getattr(block, op)(axis=axis)
+        return block.shape[axis] - 1 - getattr(_np.flip(block, axis), op)(axis=axis)
+
+    def partial(self, z0, block):
+        """Compute the projections of block (the pages z0, z0+1, ...).
+
+        Return a dict of partial results."""
+        res = {}
+        ops = self._z_ops
+        if ops & {'max', 'argmax'}:
+            if 'argmax' in ops:
+                idx = self._arg(block, 'argmax', 0)
+                res['argmax'] = idx + z0
+                res['max'] = _np.take_along_axis(block, idx[_np.newaxis], axis=0)[0]
+            else:
+                res['max'] = block.max(axis=0)
+        if ops & {'min', 'argmin'}:
+            if 'argmin' in ops:
+                idx = self._arg(block, 'argmin', 0)
+                res['argmin'] = idx + z0
+                res['min'] = _np.take_along_axis(block, idx[_np.newaxis], axis=0)[0]
+            else:
+                res['min'] = block.min(axis=0)
+        if 'sum' in ops:
+            res['sum'] = block.sum(axis=0, dtype=_sum_dtype(block.dtype))
+        if ops & {'mean', 'std'}:
+            mean = block.mean(axis=0, dtype=_np.float64)
+            res['mean'] = mean
+            if 'std' in ops:
+                res['m2'] = ((block - mean)**2).sum(axis=0)
+
+        # the projections along the other axes are complete for these pages
+        for op, axis in self.pairs:
+            if axis == 0:
+                continue
+            if op in ('mean', 'std'):
+                res[op, axis] = getattr(block, op)(axis=axis, dtype=_np.float64)
+            elif op == 'sum':
+                res[op, axis] = block.sum(axis=axis, dtype=_sum_dtype(block.dtype))
+            elif op in ('argmax', 'argmin'):
+                res[op, axis] = self._arg(block, op, axis)
+            else:
+                res[op, axis] = getattr(block, op)(axis=axis)
+        return res
+
+    def combine(self, z0, n, res):
+        """Accumulate the partial results res of the n pages z0, z0+1, ..."""
+        first = self._count == 0
+        for key, value in res.items():
+            if isinstance(key, tuple):
+                out = self._out(key, (self.shape[0],) + value.shape[1:], value.dtype)
+                out[z0:z0+n] = value
+
+        acc = self._results
+        last = 0 in self.last
+        for op, other in (('max', _np.greater_equal if last else _np.greater),
+                          ('min', _np.less_equal if last else _np.less)):
+            if op not in res:
+                continue
+            if first:
+                acc['_' + op] = res[op]
+                if 'arg' + op in res:
+                    acc['_arg' + op] = res['arg' + op]
+            elif 'arg' + op in res:
+                # the first (or last) occurrence is kept
+                better = other(res[op], acc['_' + op])
+                acc['_arg' + op] = _np.where(better, res['arg' + op], acc['_arg' + op])
+                acc['_' + op] = _np.where(better, res[op], acc['_' + op])
+            else:
+                acc['_' + op] = _np.maximum(acc['_' + op], res[op]) if op == 'max' else \
+                    _np.minimum(acc['_' + op], res[op])
+        if 'sum' in res:
+            acc['_sum'] = res['sum'] if first else acc['_sum'] + res['sum']
+        if 'mean' in res:
+            # parallel combination of mean and variance (Chan et al.)
+            if first:
+                acc['_mean'] = res['mean']
+                if 'm2' in res:
+                    acc['_m2'] = res['m2']
+            else:
+                total = self._count + n
+                delta = res['mean'] - acc['_mean']
+                if 'm2' in res:
+                    acc['_m2'] = acc['_m2'] + res['m2'] + delta**2 * (self._count * n / total)
+                acc['_mean'] = acc['_mean'] + delta * (n / total)
+        self._count += n
+
+    def result(self):
+        """Return the projections as a dict {(op, axis): array}"""
+        acc = self._results
+        out = {}
+        for op, axis in self.pairs:
+            if axis != 0:
+                out[op, axis] = acc[op, axis]
+            elif op == 'std':
+                out[op, axis] = _np.sqrt(acc['_m2'] / self._count)
+            else:
+                out[op, axis] = acc['_' + op]
+        return out
+
+
+def _iter_chunks(data, chunk):
+    """Iterate over (z0, block) of a Stack or an array of pages"""
+    if hasattr(data, 'iter_chunks'):
+        z0 = 0
+        for block in data.iter_chunks(chunk):
+            yield z0, _np.asarray(block)
+            z0 += len(block)
+    else:
+        for z0 in range(0, len(data), chunk):
+            yield z0, _np.asarray(data[z0:z0+chunk])
+
+
+def project_pairs(data, pairs, chunk=16, workers=1, last=()):
+    """Compute the projections pairs = [(op, axis), ...] of data in one pass.
+
+    See project and Projector."""
+    with _span('project', pages=len(data), pairs=len(pairs)) as event:
+        result = _project_pairs(data, pairs, chunk, workers, event, last)
+        event.allocated = sum(a.nbytes for a in result.values())
+    return result
+
+
+def _project_pairs(data, pairs, chunk, workers, event, last):
+    projector = Projector(data.shape, pairs, last)
+
+    def chunks():
+        for z0, block in _iter_chunks(data, chunk):
+            event.nbytes += block.nbytes
+            yield z0, block
+
+    def partial(item):
+        z0, block = item
+        return z0, len(block), projector.partial(z0, block)
+
+    # the chunks are read in order and reduced by the pool;
+    # at most 2*workers chunks are in memory at once
+    for z0, n, res in _ordered_map(partial, chunks(), workers):
+        projector.combine(z0, n, res)
+    return projector.result()
+
+
+def project(stack, ops=('max',), axes=(0,), chunk=16, workers=1):
+    """Compute several projections of the stack along several axes in one pass over the data.
+
+    The pages are read chunk by chunk (chunk pages at a time) and, if workers > 1,
+    reduced by a pool of threads. Each thread holds a chunk and its partial projections,
+    so the memory needed grows with the number of workers.
+
+    :param stack: a Stack (or a 3D array)
+    :param ops: the projections: 'max', 'min', 'sum', 'mean', 'std', 'argmax', 'argmin' (or one of them)
+    :param axes: the axes of the projections (depth = 0, vertical = 1, horizontal = 2) (or one of them)
+    :param workers: number of threads (default: 1, no pool)
+    :return: a dict {(op, axis): 2D array}
+    """
+    ops = (ops,) if isinstance(ops, str) else ops
+    axes = (axes,) if isinstance(axes, int) else axes
+    return project_pairs(stack, [(op, axis) for axis in axes for op in ops], chunk, workers)
+
+
+def _iter_pages(data, chunk):
+    for _, block in _iter_chunks(data, chunk):
+        yield from block
+
+
+def _sliding_extremum(pages, window, f):
+    """van Herk / Gil-Werman running max (or min, with f=np.minimum) over window pages.
+
+    The pages are split into blocks of window pages. The extremum of the window starting
+    at page k is f(suffix extremum of its first block from k, prefix extremum of the
+    next block up to k + window - 1): about 3 comparisons per pixel and page.
+    """
+    block = []
+    suffix = None
+    prefix = None
+    for page in pages:
+        j = len(block)
+        prefix = page if j == 0 else f(prefix, page)
+        block.append(page)
+        if suffix is not None and j < window - 1:
+            yield f(suffix[j + 1], prefix)
+        if len(block) == window:
+            suffix = [None] * window
+            suffix[-1] = block[-1]
+            for i in range(window - 2, -1, -1):
+                suffix[i] = f(block[i], suffix[i + 1])
+            yield _np.array(suffix[0])
+            block = []
+
+
+def _sliding_sum(pages, window, mean):
+    """Running sum (or mean) over window pages"""
+    last = _deque()
+    total = None
+    for page in pages:
+        if total is None:
+            total = page.astype(_sum_dtype(page.dtype))
+        else:
+            total += page
+        last.append(page)
+        if len(last) > window:
+            total -= last.popleft()
+        if len(last) == window:
+            yield total / window if mean else total.copy()
+
+
+def sliding_project(stack, window, op='max', chunk=16):
+    """Project the stack along z over a sliding window of pages.
+
+    Yield the projection of the pages k to k + window - 1, for k = 0 ... len(stack) - window.
+    The projections are computed incrementally (about O(1) operations per pixel and page,
+    whatever the window size) and the pages are read chunk by chunk, so that only
+    about 2 * window pages are in memory.
+
+    :param stack: a Stack (or a 3D array)
+    :param window: the number of pages of each projection
+    :param op: 'max', 'min', 'sum' or 'mean'
+    :return: a generator of 2D arrays
+    """
+    if not 1 <= window <= len(stack):
+        raise ValueError(f"The window must be between 1 and the number of pages ({len(stack)}).")
+    pages = _iter_pages(stack, chunk)
+    if op == 'max':
+        projections = _sliding_extremum(pages, window, _np.maximum)
+    elif op == 'min':
+        projections = _sliding_extremum(pages, window, _np.minimum)
+    elif op in ('sum', 'mean'):
+        projections = _sliding_sum(pages, window, op == 'mean')
+    else:
+        raise ValueError(f"Unknown projection {op}. Use 'max', 'min', 'sum' or 'mean'.")
+    return _iterate('sliding_project', projections, op=op, window=window)
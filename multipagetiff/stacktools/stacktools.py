@@ -27,7 +27,6 @@ along with MULTIPAGETIFF.  If not, see <https://www.gnu.org/licenses/>.
 
 from multipagetiff.stack.stack import Stack
 from .. import stack as _stack
-from .. import image_tools as _image_tools
 from .. import transform
 
 
@@ -45,31 +44,113 @@ def empty_like(stack, value=0):
     :return: a new Stack
     :rtype: multipagetiff.Stack
     """
-    data = _np.zeros_like(stack.pages) + value
+    pages = stack.pages
+    data = _np.full(pages.shape, value, dtype=_np.result_type(pages.dtype, value))
     new_stack = _stack.Stack(data)
     new_stack.copy_props_from_stack(stack)
     return new_stack
 
 
-def unpad_stack(stack):
+def _read_pages(imgs, idx):
+    """The pages idx (evenly spaced, ascending or descending) as an array"""
+    lo, hi = min(idx[0], idx[-1]), max(idx[0], idx[-1])
+    step = abs(idx[1] - idx[0]) if len(idx) > 1 else 1
+    block = _np.asarray(imgs[lo:hi + 1:step])
+    return block if idx[0] <= idx[-1] else block[::-1]
+
+
+def _first_nonempty(imgs, indices, chunk):
+    """Scan the pages indices chunk by chunk, stop at the first chunk with a non-empty page.
+
+    Return the index of the first non-empty page (in the order of indices)
+    and the pages of its chunk, or (None, None)."""
+    for k in range(0, len(indices), chunk):
+        idx = indices[k:k+chunk]
+        block = _read_pages(imgs, idx)
+        nonempty = _np.flatnonzero(block.reshape(len(block), -1).any(axis=1))
+        if len(nonempty):
+            return idx[nonempty[0]], block
+    return None, None
+
+
+def estimate_stack_padding(stack, sample=None, chunk=16):
+    """Estimate the padding of the raw images of a stack: the bounding box of the
+    non-zero pixels of all pages (their union).
+
+    The pages are scanned chunk by chunk (the raw images can be a memmap or a lazy source):
+    from each end of the stack until a non-empty page is found, then the pages in between
+    are only checked outside of the current bounding box, which grows from the inside out.
+
+    :param sample: number of pages to scan, evenly spaced (default: all pages)
+    :return: a dictionary of three tuples, the first and last (included) non-zero
+        pages ('z'), rows ('v') and columns ('h') in the raw images.
+    """
+    imgs = stack._imgs
+    n, h, w = imgs.shape
+    if sample is None or sample >= n:
+        indices = _np.arange(n)
+    else:
+        indices = _np.unique(_np.linspace(0, n - 1, sample).round().astype(int))
+    if len(indices) > 1 and len(_np.unique(_np.diff(indices))) > 1:
+        # the pages are read one at a time when they are not evenly spaced
+        chunk = 1
+
+    first, block = _first_nonempty(imgs, indices, chunk)
+    if first is None:
+        raise ValueError("The stack seems empty")
+    last, last_block = _first_nonempty(imgs, indices[::-1], chunk)
+
+    # bounding box in the pages, [r0, r1] x [c0, c1]
+    r0, r1, c0, c1 = h, -1, w, -1
+
+    def grow(block):
+        nonlocal r0, r1, c0, c1
+        if r1 < 0:
+            rows = block.any(axis=(0, 2))
+            if not rows.any():
+                return
+            rows = _np.flatnonzero(rows)
+            cols = _np.flatnonzero(block.any(axis=(0, 1)))
+            r0, r1, c0, c1 = int(rows[0]), int(rows[-1]), int(cols[0]), int(cols[-1])
+            return
+        # only the pixels outside of the current bounding box are checked
+        if r0 > 0 and block[:, :r0, :].any():
+            r0 = int(_np.flatnonzero(block[:, :r0, :].any(axis=(0, 2)))[0])
+        if r1 < h - 1 and block[:, r1+1:, :].any():
+            r1 = r1 + 1 + int(_np.flatnonzero(block[:, r1+1:, :].any(axis=(0, 2)))[-1])
+        if c0 > 0 and block[:, :, :c0].any():
+            c0 = int(_np.flatnonzero(block[:, :, :c0].any(axis=(0, 1)))[0])
+        if c1 < w - 1 and block[:, :, c1+1:].any():
+            c1 = c1 + 1 + int(_np.flatnonzero(block[:, :, c1+1:].any(axis=(0, 1)))[-1])
+
+    grow(block)
+    grow(last_block)
+
+    # the pages between the two chunks already scanned
+    inner = indices[(indices > first) & (indices < last)]
+    for k in range(0, len(inner), chunk):
+        if r0 == 0 and c0 == 0 and r1 == h - 1 and c1 == w - 1:
+            break
+        grow(_read_pages(imgs, inner[k:k+chunk]))
+
+    return dict(z=(int(first), int(last)), v=(r0, r1), h=(c0, c1))
+
+
+def unpad_stack(stack, pages=False, sample=None):
     """Un-pad the stack by setting an appropriate crop.
-    The padding is estimated from the first non-empty page.
+    The padding is the bounding box of the non-zero pixels of all the pages
+    (or of sample pages, evenly spaced), see estimate_stack_padding.
     The unpadding is done inplace.
-    
+
+    :param pages: also set the page limits to the first and last non-empty pages
+
     Return:
         None"""
 
-    # Estimate the padding in a stack from the first non-empty image
-    for i in range(len(stack._imgs)):
-        try:
-            pad = _image_tools.estimate_zero_padding(stack._imgs[i])
-            break
-        except _image_tools.EmptyImageException:
-            continue
-    else:
-        raise ValueError("The stack seems empty")
-
-    stack.crop = [pad['v'][0], pad['v'][1], pad['h'][0], pad['h'][1]]
+    pad = estimate_stack_padding(stack, sample=sample)
+    stack.crop = [pad['v'][0], pad['v'][1] + 1, pad['h'][0], pad['h'][1] + 1]
+    if pages:
+        stack.page_limits = [pad['z'][0], pad['z'][1] + 1]
 
 
 def _get_orthogonal_slices(stack, z, v, h):
@@ -87,10 +168,41 @@ def _get_orthogonal_slices(stack, z, v, h):
     return dict(vh=vh, zv=zv, zh=zh, vz=zv.T, hz=zh.T)
 
 
-def affine_transform(stack, matrix):
+def affine_transform(stack, matrix, order=3, output_dtype=None, tile_shape=(64, 128, 128), workers=None):
     """Apply a 3D affine transformation to the pages of the input stack.
-    Return the result in a new stack."""
+    Return the result in a new stack.
+
+    matrix is a 3x3 or 4x4 homogeneous matrix, or a transform.Transform
+    (to apply the same transformation to many stacks, with its own order).
+    See transform.affine3D for the other parameters."""
 
-    img = stack.pages.copy()
-    out = transform.affine3D(img, matrix)
+    if isinstance(matrix, transform.Transform):
+        out = matrix.apply(stack.pages, output_dtype=output_dtype, tile_shape=tile_shape, workers=workers)
+    else:
+        out = transform.affine3D(stack.pages, matrix, order=order, output_dtype=output_dtype,
+                                 tile_shape=tile_shape, workers=workers)
     return Stack(out)
+
+
+def resample_isotropic(stack, spacing=None, order=1, output_dtype=None):
+    """Resample the pages of the stack to the same pixel size along the three axes.
+
+    The stack is scaled by dz/spacing along z and dx/spacing along x and y.
+    Each axis is interpolated separately, a few pages at a time, so that only
+    the output and a few pages are in memory.
+
+    :param spacing: the pixel size of the result, in physical units (default: dx)
+    :param order: 0 for nearest neighbour, 1 for linear interpolation
+    :param output_dtype: the data type of the result (default: the data type of the stack)
+    :return: a new Stack, with dx = dz = spacing
+    """
+    if order not in (0, 1):
+        raise ValueError("Only order 0 (nearest) and 1 (linear) are supported.")
+    spacing = stack.dx if spacing is None else spacing
+
+    pages = stack.pages
+    scale = _np.diag([stack.dz / spacing, stack.dx / spacing, stack.dx / spacing])
+    out = transform.Transform(scale, pages.shape, order=order).apply(pages, output_dtype=output_dtype)
+
+    new_stack = Stack(out, dx=spacing, dz=spacing, title=stack.title, z_label=stack.z_label, units=stack.units)
+    return new_stack
@@ -1 +1 @@
-from .affine3d import affine3D
+from .affine3d import affine3D, Transform, calc_transf_image_shape
@@ -1,5 +1,41 @@
-from scipy.ndimage import affine_transform
+from scipy.ndimage import affine_transform, spline_filter
+from concurrent import futures
+import itertools
+import os
 import numpy as np
+from ..profiling import span
+
+# samples added around the footprint of a tile before the spline prefilter,
+# the same padding used by scipy.ndimage for the modes without exact boundary conditions
+PREFILTER_MARGIN = 12
+
+
+def homogeneous_matrix(matrix):
+    """Return matrix as a 4x4 homogeneous transformation matrix.
+
+    matrix can be a 3x3 linear transformation or a 4x4 homogeneous matrix
+    (whose last column is the translation and last row is [0, 0, 0, 1]).
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    if matrix.shape == (3, 3):
+        h = np.eye(4)
+        h[:3, :3] = matrix
+        return h
+    if matrix.shape == (4, 4):
+        if not np.allclose(matrix[3], [0, 0, 0, 1]):
+            raise ValueError("The last row of a 4x4 matrix must be [0, 0, 0, 1].")
+        return matrix
+    raise ValueError("ERROR: Only 3x3 and 4x4 matrices are supported.")
+
+
+def _transformed_corners(shape, matrix):
+    """The coordinates of the corners of an image of the given shape, transformed by
+    the homogeneous matrix. Shape (3, 8)."""
+    d, h, w = shape
+    corners = np.float64([
+        [0, 0, 0], [0, h-1, 0], [0, 0, w-1], [0, h-1, w-1],
+        [d-1, 0, 0], [d-1, h-1, 0], [d-1, 0, w-1], [d-1, h-1, w-1]])
+    return matrix[:3, :3] @ corners.T + matrix[:3, 3:]
 
 
 def calc_transf_image_shape(img, matrix):
@@ -8,59 +44,405 @@ def calc_transf_image_shape(img, matrix):
     its transformation by matrix.
 
     matrix transforms the coordinate of img in the output coordnates.
+    It can be a 3x3 matrix or a 4x4 homogeneous matrix (including a translation).
+    The output is the bounding box of the transformed image: the transformed corner
+    with the lowest coordinates is at index 0.
 
-    e.g. Using scipy.ndimage to transform `img` into `out`,  
-    if `M` is the tranformation matrix and `M_inv` its inverse:
+    Return the output shape and the offset for scipy.ndimage:
+    e.g. Using scipy.ndimage to transform `img` into `out`,
+    if `M` is the tranformation matrix (3x3) and `M_inv` its inverse:
 
-    d = calc_transf_image_shape(img, M)
-    out = nd.affine_transform(img, M_inv, output_shape=d)
+    d, offset = calc_transf_image_shape(img, M)
+    out = nd.affine_transform(img, M_inv, offset=offset, output_shape=d)
 
     """
+    matrix = homogeneous_matrix(matrix)
+    cornersT = _transformed_corners(img.shape, matrix)
+    minT = cornersT.min(axis=1)
 
-    if matrix.shape != (3, 3):
-        raise ValueError("ERROR: Only 3x3 matrices are supported.")
+    # output index o is at the coordinates o + minT, which come from the input
+    # coordinates A^-1 (o + minT - t) = A^-1 o + offset
+    offset = np.linalg.solve(matrix[:3, :3], minT - matrix[:3, 3])
 
-    d, h, w = img.shape
-    corners = np.float32([
-        [0, 0, 0], [0, h-1, 0], [0, 0, w-1], [0, h-1, w-1],
-        [d-1, 0, 0], [d-1, h-1, 0], [d-1, 0, w-1], [d-1, h-1, w-1]])
+    # the output contains all the integer coordinates among the furthest corners
+    # (the tolerance avoids an extra plane because of rounding errors)
+    shapeT = np.floor(cornersT.max(axis=1) - minT + 1e-6).astype(int) + 1
+
+    return shapeT, offset
 
-    # Transformed corners
 
-    cornersT = np.dot(matrix, corners.T)
-    minT = cornersT.min(axis=1)
+def _tiles(shape, tile_shape):
+    """Iterate over the (start, stop) corners of the tiles covering shape"""
+    ranges = [range(0, n, t) for n, t in zip(shape, tile_shape)]
+    for start in itertools.product(*ranges):
+        stop = tuple(min(s + t, n) for s, t, n in zip(start, tile_shape, shape))
+        yield np.array(start), np.array(stop)
 
-    # negative coordinates must be compensated by an offset
-    offset = np.where(minT < 0, minT, 0).astype(int)
-    offset = offset/matrix.diagonal()
 
-    # the output shape is the distance among the furtest corners
-    shapeT = np.ceil(cornersT.max(axis=1) - minT).astype(int)
-    # print(minT, shapeT)
+def _footprint(m_inv, offset, start, stop):
+    """Bounds (min, max) of the input coordinates sampled by the output tile [start, stop)"""
+    corners = np.array(list(itertools.product(*zip(start, stop - 1))), dtype=np.float64)
+    coords = corners @ m_inv.T + offset
+    return coords.min(axis=0), coords.max(axis=0)
+
+
+def _tile_coordinates(m_inv, offset, start, stop):
+    """Input coordinates sampled by the points of the output tile [start, stop), one array per axis.
+
+    Each coordinate is computed from the global output indices, so it does not depend on the tiling."""
+    axes = [np.arange(a, b, dtype=np.float64) for a, b in zip(start, stop)]
+    return [m_inv[i, 0] * axes[0][:, None, None] + m_inv[i, 1] * axes[1][None, :, None]
+            + m_inv[i, 2] * axes[2][None, None, :] + offset[i] for i in range(3)]
+
+
+def _outside_mask(m_inv, offset, start, stop, in_shape, tol=1e-6):
+    """Mask of the points of the output tile [start, stop) which sample outside the input image"""
+    mask = np.zeros(tuple(stop - start), dtype=bool)
+    for c, n in zip(_tile_coordinates(m_inv, offset, start, stop), in_shape):
+        mask |= (c < -tol) | (c > n - 1 + tol)
+    return mask
+
+
+def _nearest_tile(img, m_inv, offset, start, stop, tile, cval, tol=1e-6):
+    """Compute the output tile [start, stop) by nearest neighbour interpolation.
+
+    The coordinates are rounded as scipy does (half-integers upwards), with a tolerance,
+    so that the points at half-integer coordinates are rounded the same way in every tile."""
+    in_shape = img.shape
+    coords = _tile_coordinates(m_inv, offset, start, stop)
+    outside = np.zeros(tile.shape, dtype=bool)
+    index = []
+    for c, n in zip(coords, in_shape):
+        outside |= (c < -tol) | (c > n - 1 + tol)
+        index.append(np.clip(np.floor(c + 0.5 + tol).astype(np.intp), 0, n - 1))
+    tile[...] = img[tuple(index)]
+    tile[outside] = cval
+
+
+def _transform_tile(img, m_inv, offset, start, stop, out, order, cval):
+    """Compute the output tile [start, stop) from the input footprint only"""
+    in_shape = np.array(img.shape)
+    tile = out[tuple(slice(a, b) for a, b in zip(start, stop))]
+    cmin, cmax = _footprint(m_inv, offset, start, stop)
+    margin = order + 1
+    lo = np.clip(np.floor(cmin).astype(int) - margin, 0, in_shape)
+    hi = np.clip(np.ceil(cmax).astype(int) + margin + 1, 0, in_shape)
+    if (hi <= lo).any() or (cmax < 0).any() or (cmin > in_shape - 1).any():
+        # the tile samples only outside the input image
+        tile[...] = cval
+        return
+
+    if order == 0:
+        _nearest_tile(img, m_inv, offset, start, stop, tile, cval)
+        return
+
+    if order > 1:
+        # the spline coefficients are computed on a larger region, so that they are
+        # not affected by its borders (except at the borders of the image)
+        lo_f = np.maximum(lo - PREFILTER_MARGIN, 0)
+        hi_f = np.minimum(hi + PREFILTER_MARGIN, in_shape)
+        region = img[tuple(slice(a, b) for a, b in zip(lo_f, hi_f))]
+        region = spline_filter(region, order, output=np.float64, mode='constant')
+        region = region[tuple(slice(a, b) for a, b in zip(lo - lo_f, hi - lo_f))]
+    else:
+        region = img[tuple(slice(a, b) for a, b in zip(lo, hi))]
+
+    # Inside the image, the 'constant' mode of scipy extends the data by mirroring it:
+    # the region is extended the same way at the borders of the image.
+    # The points outside the image are set to cval, with a tolerance on their coordinates
+    # so that the result does not depend on the rounding errors of the tile offsets.
+    tile_offset = m_inv @ start + offset - lo
+    affine_transform(region, m_inv, offset=tile_offset, output=tile, order=order,
+                     mode='mirror', prefilter=False)
+    if (cmin < 0).any() or (cmax > in_shape - 1).any():
+        tile[_outside_mask(m_inv, offset, start, stop, in_shape)] = cval
+
+
+def _transform_tiles(img, m_inv, offset, out, order, cval, tile_shape, workers):
+    tiles = list(_tiles(out.shape, tile_shape))
+    workers = os.cpu_count() if workers is None else workers
+    if workers <= 1 or len(tiles) == 1:
+        for start, stop in tiles:
+            _transform_tile(img, m_inv, offset, start, stop, out, order, cval)
+    else:
+        # scipy.ndimage releases the GIL: the tiles are computed in parallel
+        with futures.ThreadPoolExecutor(workers) as executor:
+            jobs = [executor.submit(_transform_tile, img, m_inv, offset, start, stop, out, order, cval)
+                    for start, stop in tiles]
+            for job in jobs:
+                job.result()
+
+
+def _axis_weights(n_in, n_out, scale, offset, order, tol=1e-6):
+    """Interpolation along one axis: input coordinates scale * o + offset of the output indices o.
+
+    Return the indices of the two input neighbours, the weight of the second
+    and a mask of the output indices inside the input."""
+    c = scale * np.arange(n_out) + offset
+    valid = (c >= -tol) & (c <= n_in - 1 + tol)
+    if order == 0:
+        i0 = np.clip(np.floor(c + 0.5).astype(np.intp), 0, n_in - 1)
+        return i0, i0, np.zeros(n_out), valid
+    i0 = np.clip(np.floor(c).astype(np.intp), 0, max(n_in - 2, 0))
+    i1 = np.minimum(i0 + 1, n_in - 1)
+    return i0, i1, np.clip(c - i0, 0, 1), valid
 
-    return shapeT, offset
 
+def _interpolate_axis(a, i0, i1, w, axis, work_dtype):
+    shape = [1] * a.ndim
+    shape[axis] = len(w)
+    w = w.astype(work_dtype).reshape(shape)
+    result = a.take(i0, axis=axis).astype(work_dtype)
+    if (i1 != i0).any():
+        result *= 1 - w
+        result += a.take(i1, axis=axis) * w
+    return result
 
-def affine3D(img, matrix):
+
+def _resample_separable(img, scale, offset, out, order, cval, chunk=16):
+    """Transform img by an axis-aligned scaling (input coordinates scale * o + offset),
+    interpolating each axis separately, for chunk output planes at a time."""
+    work_dtype = np.float64 if img.dtype.itemsize > 4 or out.dtype == np.float64 else np.float32
+    integer_output = out.dtype.kind in 'uib'
+    weights = [_axis_weights(n_in, n_out, s, o, order)
+               for n_in, n_out, s, o in zip(img.shape, out.shape, scale, offset)]
+    (z0s, z1s, wz, vz), (y0, y1, wy, vy), (x0, x1, wx, vx) = weights
+
+    for k in range(0, out.shape[0], chunk):
+        z = slice(k, min(k + chunk, out.shape[0]))
+        a = int(min(z0s[z].min(), z1s[z].min()))
+        b = int(max(z0s[z].max(), z1s[z].max())) + 1
+        # only the input planes needed by this chunk are read
+        block = np.asarray(img[a:b])
+        block = _interpolate_axis(block, y0, y1, wy, 1, work_dtype)
+        block = _interpolate_axis(block, x0, x1, wx, 2, work_dtype)
+        block = _interpolate_axis(block, z0s[z] - a, z1s[z] - a, wz[z], 0, work_dtype)
+        if integer_output:
+            np.rint(block, out=block)
+        out[z] = block
+        out[z][~vz[z]] = cval
+
+    out[:, ~vy, :] = cval
+    out[:, :, ~vx] = cval
+    return out
+
+
+class Transform:
+    """An affine transformation of 3D images of a given shape.
+
+    The output shape and the mapping from output to input coordinates are computed once,
+    and the transformation can be applied to any number of images of the same shape.
+
+    Axis-aligned scalings with order 0 and 1 are computed separately along each axis,
+    a few output planes at a time, which is much faster than the general transformation.
+
+    If cache_maps is True (only for order 0 and 1) the input coordinates of each
+    output point are also computed once: the indices of the nearest input points (order 0),
+    or the indices of the base input points and the fractional coordinates (order 1).
+    Applying the transformation is then a gather of the input values, much faster than
+    computing it from scratch, but the maps take 8 (order 0) to 20 (order 1) bytes per
+    output point.
+
+    Attributes:
+        matrix: the 4x4 homogeneous matrix, from input to output coordinates
+        input_shape, output_shape: the shapes of the input and output images
+        inverse, offset: the mapping from output indices o to input coordinates (inverse @ o + offset)
+    """
+
+    def __init__(self, matrix, input_shape, order=3, output_shape=None, origin=None, cval=0.0, cache_maps=False):
+        """
+        Args:
+            matrix (array): 3x3 or 4x4 homogeneous affine transformation matrix
+            input_shape (tuple): the shape of the images to transform
+            order (int): the order of the spline interpolation (0 to 5, 0: nearest, 1: linear)
+            output_shape (tuple): the shape of the output (default: the bounding box of the transformed image)
+            origin (array): output coordinates of the output index (0,0,0)
+                (default: the lowest corner of the transformed image)
+            cval (float): value of the output points outside the input image
+            cache_maps (bool): cache the coordinate maps (order 0 and 1 only)
+
+        Raises:
+            ValueError: if the matrix is not 3x3 or 4x4, or if cache_maps is set with order > 1
+        """
+        if order < 0 or order > 5:
+            raise ValueError("The spline order must be between 0 and 5.")
+        if cache_maps and order > 1:
+            raise ValueError("The coordinate maps can only be cached for order 0 and 1.")
+
+        self.matrix = homogeneous_matrix(matrix)
+        self.input_shape = tuple(int(n) for n in input_shape)
+        self.order = order
+        self.cval = cval
+        self.cache_maps = cache_maps
+
+        corners = _transformed_corners(self.input_shape, self.matrix)
+        if origin is None:
+            origin = corners.min(axis=1)
+        if output_shape is None:
+            output_shape = np.floor(corners.max(axis=1) - origin + 1e-6).astype(int) + 1
+        self.output_shape = tuple(int(n) for n in output_shape)
+
+        self.inverse = np.linalg.inv(self.matrix[:3, :3])
+        self.offset = self.inverse @ (np.asarray(origin, dtype=np.float64) - self.matrix[:3, 3])
+        self._maps = None
+
+    @property
+    def is_axis_aligned(self):
+        """True if the transformation is an axis-aligned scaling (and translation)"""
+        return np.count_nonzero(self.inverse - np.diag(np.diagonal(self.inverse))) == 0
+
+    def __repr__(self):
+        return "Transform({} -> {}, order={}, cache_maps={})".format(
+            self.input_shape, self.output_shape, self.order, self.cache_maps)
+
+    def _coordinates(self, z0, z1):
+        """The input coordinates of the output planes z0 to z1, flattened. Shape (3, n)."""
+        d, h, w = self.output_shape
+        z, y, x = np.arange(z0, z1), np.arange(h), np.arange(w)
+        coords = np.empty((3, z1 - z0, h, w), dtype=np.float64)
+        for i in range(3):
+            coords[i] = (self.inverse[i, 0] * z[:, None, None] + self.inverse[i, 1] * y[None, :, None]
+                         + self.inverse[i, 2] * x[None, None, :] + self.offset[i])
+        return coords.reshape(3, -1)
+
+    def _compute_maps(self, slab=16, tol=1e-6):
+        """Compute the coordinate maps, a few output planes at a time"""
+        in_shape = np.array(self.input_shape)
+        strides = np.array([in_shape[1] * in_shape[2], in_shape[2], 1])
+        index_dtype = np.int32 if np.prod(in_shape) < 2**31 else np.int64
+        plane = self.output_shape[1] * self.output_shape[2]
+        valid, base, frac = [], [], []
+        for z0 in range(0, self.output_shape[0], slab):
+            z1 = min(z0 + slab, self.output_shape[0])
+            c = self._coordinates(z0, z1)
+            inside = ((c >= -tol) & (c <= in_shape[:, None] - 1 + tol)).all(axis=0)
+            c = c[:, inside]
+            valid.append(np.flatnonzero(inside) + z0 * plane)
+            if self.order == 0:
+                idx = np.clip(np.floor(c + 0.5).astype(np.int64), 0, in_shape[:, None] - 1)
+                base.append((strides @ idx).astype(index_dtype))
+            else:
+                # the base point is clipped so that its neighbour (+1) is inside the image
+                b = np.clip(np.floor(c).astype(np.int64), 0, np.maximum(in_shape[:, None] - 2, 0))
+                base.append((strides @ b).astype(index_dtype))
+                frac.append(np.clip(c - b, 0, 1).astype(np.float32))
+        self._maps = dict(valid=np.concatenate(valid), base=np.concatenate(base),
+                          frac=np.concatenate(frac, axis=1) if frac else None)
+
+    def _apply_maps(self, img, out, chunk=2**20):
+        if self._maps is None:
+            self._compute_maps()
+        valid, base, frac = self._maps['valid'], self._maps['base'], self._maps['frac']
+        src = np.ascontiguousarray(img).reshape(-1)
+        dst = out.reshape(-1)
+        dst[...] = self.cval
+        integer_output = out.dtype.kind in 'uib'
+        work_dtype = np.float64 if img.dtype.itemsize > 4 or out.dtype == np.float64 else np.float32
+
+        in_shape = self.input_shape
+        # neighbours along an axis of length 1 are the point itself
+        steps = [in_shape[1] * in_shape[2] if in_shape[0] > 1 else 0,
+                 in_shape[2] if in_shape[1] > 1 else 0,
+                 1 if in_shape[2] > 1 else 0]
+
+        for k in range(0, len(valid), chunk):
+            v = valid[k:k+chunk]
+            b = base[k:k+chunk]
+            if self.order == 0:
+                dst[v] = src[b]
+                continue
+            fz, fy, fx = (f.astype(work_dtype, copy=False) for f in frac[:, k:k+chunk])
+            result = 0
+            for dz, wz in ((0, 1 - fz), (steps[0], fz)):
+                plane = 0
+                for dy, wy in ((0, 1 - fy), (steps[1], fy)):
+                    row = src[b + dz + dy].astype(work_dtype) * (1 - fx) + src[b + dz + dy + steps[2]] * fx
+                    plane = plane + wy * row
+                result = result + wz * plane
+            if integer_output:
+                result = np.rint(result)
+            dst[v] = result
+        return out
+
+    def apply(self, img, out=None, output_dtype=None, tile_shape=(64, 128, 128), workers=None):
+        """Transform img.
+
+        Args:
+            img (array): 3D image of shape input_shape
+            out (array): preallocated output array, of shape output_shape
+            output_dtype: the data type of the output (default: the data type of img)
+            tile_shape (tuple): the shape of the output tiles (if the maps are not cached)
+            workers (int): number of threads (default: the number of CPUs)
+
+        Returns:
+            array: the transformed image.
+        """
+        if not hasattr(img, 'shape'):
+            img = np.asarray(img)
+        if tuple(img.shape) != self.input_shape:
+            raise ValueError(f"The image has shape {tuple(img.shape)}, expected {self.input_shape}")
+        allocated = out is None
+        if out is None:
+            out = np.empty(self.output_shape, dtype=img.dtype if output_dtype is None else output_dtype)
+        elif out.shape != self.output_shape:
+            raise ValueError(f"out has shape {out.shape}, expected {self.output_shape}")
+
+        with span('transform', order=self.order) as event:
+            event.details['method'] = self._apply(img, out, tile_shape, workers)
+            event.pages = self.input_shape[0]
+            event.nbytes = int(np.prod(self.input_shape)) * np.dtype(img.dtype).itemsize
+            event.allocated = out.nbytes if allocated else 0
+        return out
+
+    __call__ = apply
+
+    def _apply(self, img, out, tile_shape, workers):
+        """Write the transformed img in out and return the name of the method used"""
+        if self.order <= 1 and self.is_axis_aligned and not self.cache_maps:
+            # img can be a lazy stack of pages: only the needed pages are read
+            _resample_separable(img, np.diagonal(self.inverse), self.offset, out, self.order, self.cval)
+            return 'separable'
+
+        img = np.asarray(img)
+        if self.cache_maps:
+            if out.flags.c_contiguous:
+                self._apply_maps(img, out)
+            else:
+                out[...] = self._apply_maps(img, np.empty(out.shape, dtype=out.dtype))
+            return 'maps'
+
+        _transform_tiles(img, self.inverse, self.offset, out, self.order, self.cval, tile_shape, workers)
+        return 'tiles'
+
+
+def affine3D(img, matrix, order=3, output_dtype=None, tile_shape=(64, 128, 128), workers=None, out=None, cval=0.0):
     """Apply an affine transformation to a 3D image
     Matrix is the direct transformation matrix from the image to its output.
     The output image has the correct shape to hold it entirely.
 
     This function calls scipy.ndimage.affine_transform using the inverse of matrix.
+    The output is split into tiles, and each tile is computed from the region of the input
+    that it samples (its footprint through the inverse matrix). The tiles are computed
+    in parallel by a pool of threads and written directly into the output array.
+
+    To apply the same transformation to many images of the same shape, use a Transform.
 
     Args:
         img (array): 3D image to transform
-        matrix (array): 3x3 affine transformation matrix
+        matrix (array): 3x3 affine transformation matrix, or 4x4 homogeneous matrix
+        order (int): the order of the spline interpolation (0 to 5, 0: nearest, 1: linear)
+        output_dtype: the data type of the output (default: the data type of img)
+        tile_shape (tuple): the shape of the output tiles
+        workers (int): number of threads (default: the number of CPUs)
+        out (array): preallocated output array, of the shape of the transformed image
+        cval (float): value of the output points outside the input image
 
     Raises:
-        ValueError: if the shape of matrix is not (3,3)
+        ValueError: if the shape of matrix is not (3,3) or (4,4)
 
     Returns:
         array: the transformed image.
     """
-    if matrix.shape != (3, 3):
-        raise ValueError("ERROR: Only 3x3 matrices are supported.")
-
-    m_inv = np.linalg.inv(matrix)
-    shp, offset = calc_transf_image_shape(img, matrix)
-    return affine_transform(img, m_inv, offset=offset, output_shape=shp)
+    img = np.asarray(img)
+    transform = Transform(matrix, img.shape, order=order, cval=cval)
+    return transform.apply(img, out=out, output_dtype=output_dtype, tile_shape=tile_shape, workers=workers)
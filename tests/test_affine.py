@@ -0,0 +1,11 @@
+import numpy as np
+import pytest
+from multipagetiff.transform import affine3D
+
+
+@pytest.mark.parametrize('tile_shape', [(16, 32, 32), (7, 11, 13)])
+def test_nearest_neighbour_does_not_depend_on_tiles(tile_shape):
+    img = np.random.default_rng(0).random((40, 70, 90)).astype('float32')
+    shear = np.array([[1, 0, 0], [0.5, 1, 0], [0, 0, 1.]])
+    single = affine3D(img, shear, order=0, tile_shape=img.shape, workers=1)
+    np.testing.assert_array_equal(affine3D(img, shear, order=0, tile_shape=tile_shape, workers=2), single)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import multipagetiff as mt
+from multipagetiff.io.batch import BatchError
+
+
+@pytest.fixture
+def paths(tmp_path):
+    paths = []
+    for i in range(4):
+        path = str(tmp_path / f'{i}.tif')
+        mt.write_stack(mt.Stack(np.full((3, 4, 5), i, dtype='uint8')), path)
+        paths.append(path)
+    bad = tmp_path / 'bad.tif'
+    bad.write_bytes(b'not a tiff')
+    return [str(bad)] + paths[:2] + [str(bad)] + paths[2:]
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_shared_output_captures_errors(paths, executor):
+    report = mt.load_and_apply_batch(paths, np.max, ncpu=2, shared_output=True, executor=executor,
+                                     chunksize=2, errors='capture')
+    assert [r.index for r in report.failed] == [0, 3]
+    assert report.results == [None, 0, 1, None, 2, 3]
+    with pytest.raises(BatchError):
+        mt.load_and_apply_batch(paths, np.max, ncpu=2, shared_output=True, executor=executor)
+
+
+def test_shared_output_rejects_journal(paths, tmp_path):
+    with pytest.raises(ValueError):
+        mt.load_and_apply_batch(paths, np.max, shared_output=True, journal=str(tmp_path / 'journal'))
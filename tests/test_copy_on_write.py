@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import multipagetiff as mt
+from multipagetiff import Stack
+
+
+def test_copy_protects_pages_read_before_copy():
+    s = Stack(np.zeros((3, 4, 5), dtype='uint8'))
+    s.pages
+    c = s.copy()
+    with pytest.raises(ValueError):
+        s.pages[0, 0, 0] = 9
+    s[0, 0, 0] = 9
+    assert c.pages[0, 0, 0] == 0
+    assert s.pages[0, 0, 0] == 9
+
+
+def test_write_after_copy_unshared():
+    s = Stack(np.zeros((3, 4, 5), dtype='uint8'))
+    c = s.copy()
+    s.pages
+    c[0] = 1
+    s[0] = 2
+    assert (s.pages[0] == 2).all()
+    assert (c.pages[0] == 1).all()
+
+
+def test_statistics_after_write():
+    s = Stack(np.zeros((3, 4, 5), dtype='uint8'))
+    c = s.copy()
+    s.max
+    c[0] = 7
+    assert c.max == 7
+    assert s.max == 0
+
+    s = Stack(np.zeros((3, 4, 5), dtype='uint8'))
+    assert s.max == 0
+    s[0] = 5
+    assert s.max == 5
+
+
+def test_iter_chunks_of_shared_stack_are_read_only():
+    s = Stack(np.zeros((3, 4, 5), dtype='uint8'))
+    c = s.copy()
+    with pytest.raises(ValueError):
+        s.apply_to_pages(lambda p: p.__iadd__(1))
+    assert (c.pages == 0).all()
+    s.apply_to_pages(lambda p: p.__iadd__(1), copy=True)
+    assert (c.pages == 0).all()
+
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_write_to_lazy_stack(tmp_path, shared):
+    path = str(tmp_path / 'a.tif')
+    mt.write_stack(Stack(np.zeros((3, 4, 5), dtype='uint8')), path, compression='deflate')
+    s = mt.read_stack(path, lazy=True)
+    c = s.copy() if shared else None
+    s.pages
+    s[0, 1, 2] = 7
+    assert s.pages[0, 1, 2] == 7
+    assert s.max == 7
+    if shared:
+        assert c.pages[0, 1, 2] == 0
@@ -0,0 +1,54 @@
+import struct
+import numpy as np
+import pytest
+import multipagetiff as mt
+
+
+def write_imagej(path, data):
+    """Write data (n, h, w) uint16 as an ImageJ hyperstack: a single IFD followed by all the pages"""
+    n, h, w = data.shape
+    description = f"ImageJ=1.53t\nimages={n}\nslices={n}\n".encode() + b'\x00'
+    entries = [(256, 3, 1, w), (257, 3, 1, h), (258, 3, 1, 16), (259, 3, 1, 1), (262, 3, 1, 1),
+               (270, 2, len(description), None), (273, 4, 1, None), (277, 3, 1, 1),
+               (278, 3, 1, h), (279, 4, 1, h * w * 2)]
+    ifd_offset = 8
+    ifd_size = 2 + 12 * len(entries) + 4
+    description_offset = ifd_offset + ifd_size
+    data_offset = description_offset + len(description)
+    ifd = struct.pack('<H', len(entries))
+    for tag, ftype, count, value in entries:
+        if tag == 270:
+            value = description_offset
+        elif tag == 273:
+            value = data_offset
+        if ftype == 3:
+            ifd += struct.pack('<HHIHH', tag, ftype, count, value, 0)
+        else:
+            ifd += struct.pack('<HHII', tag, ftype, count, value)
+    ifd += struct.pack('<I', 0)
+    with open(path, 'wb') as fh:
+        fh.write(b'II' + struct.pack('<HI', 42, ifd_offset) + ifd + description)
+        fh.write(data.astype('<u2').tobytes())
+
+
+@pytest.fixture
+def imagej(tmp_path):
+    data = np.arange(4 * 6 * 5, dtype='uint16').reshape(4, 6, 5) * 3
+    path = str(tmp_path / 'imagej.tif')
+    write_imagej(path, data)
+    return path, data
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_imagej_pages(imagej, mmap):
+    path, data = imagej
+    np.testing.assert_array_equal(mt.io.tiff2nparray(path, mmap=mmap), data)
+    np.testing.assert_array_equal(mt.io.tiff2nparray(path, mmap=mmap, start=1, step=2, crop=[1, 4, 2, 5]),
+                                  data[1::2, 1:4, 2:5])
+
+
+def test_imagej_lazy(imagej):
+    path, data = imagej
+    stack = mt.read_stack(path, mmap=False, lazy=True)
+    assert stack[2][0, 0] == data[2, 0, 0]
+    np.testing.assert_array_equal(np.asarray(stack.pages), data)
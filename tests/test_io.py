@@ -0,0 +1,13 @@
+import numpy as np
+import pytest
+import multipagetiff as mt
+
+
+@pytest.mark.parametrize('compression', [None, 'deflate'])
+@pytest.mark.parametrize('crop', [[10, 2, 0, 3], [0, 3, 4, 4], [50, 60, 0, 3]])
+def test_empty_crop_raises(tmp_path, compression, crop):
+    path = str(tmp_path / 'a.tif')
+    mt.write_stack(mt.Stack(np.zeros((3, 20, 30), dtype='uint16')), path, compression=compression)
+    with pytest.raises(ValueError, match='crop region'):
+        mt.io.tiff2nparray(path, crop=crop)
+    assert mt.io.tiff2nparray(path, crop=[2, 10, 0, 3]).shape == (3, 8, 3)
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+import multipagetiff as mt
+
+
+@pytest.mark.parametrize('clip', [None, (1, 99)])
+def test_parallel_normalize_computes_limits_once(clip):
+    data = np.random.default_rng(0).integers(0, 1000, (32, 8, 9)).astype('uint16')
+    stack = mt.Stack(data)
+
+    def pages_read(workers):
+        reads = []
+        pipeline = stack.lazy().map(lambda block: reads.append(len(block)) or block).normalize('uint8', clip=clip)
+        return list(pipeline.iter_chunks(4, workers=workers)), sum(reads)
+
+    blocks, parallel_reads = pages_read(4)
+    # the limits are computed by one thread only
+    assert parallel_reads == pages_read(1)[1]
+    expected = stack.lazy().normalize('uint8', clip=clip).compute()
+    np.testing.assert_array_equal(np.concatenate(blocks), expected)
@@ -0,0 +1,24 @@
+import sys
+import numpy as np
+import pytest
+import multipagetiff as mt
+
+plot = sys.modules['multipagetiff.plot.plot']
+projection = sys.modules['multipagetiff.stacktools.projection']
+
+
+@pytest.mark.parametrize('axis', [1, 2])
+@pytest.mark.parametrize('chunk', [3, 16])
+def test_color_coded_projections_match_flatten_with_ties(axis, chunk):
+    data = np.random.default_rng(1).integers(0, 4, (12, 20, 30)).astype('uint8')
+    stack = mt.Stack(data)
+    pairs = [('max', i) for i in range(3)] + [('argmax', i) for i in range(3)] + [('min', 1), ('min', 2)]
+    p = projection.project_pairs(stack, pairs, chunk=chunk, last=(1, 2))
+    np.testing.assert_allclose(plot._flatten_projections(p, axis, stack.shape), plot.flatten(stack, axis=axis))
+
+
+def test_last_occurrence_along_pages():
+    data = np.random.default_rng(2).integers(0, 3, (12, 5, 6))
+    p = projection.project_pairs(data, [('argmax', 0), ('argmin', 0)], chunk=5, last=(0,))
+    assert (p['argmax', 0] == len(data) - 1 - data[::-1].argmax(0)).all()
+    assert (p['argmin', 0] == len(data) - 1 - data[::-1].argmin(0)).all()